@@ -15,13 +15,86 @@
 # Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import os
 import re
 import ConfigParser
 import subprocess
+import Queue
+import hashlib
+import cPickle
+
+from threading import Thread, RLock
+
+# bump when layout of snapshot changes (it is also tied to the source of this module, see: code_version())
+SNAPSHOT_FORMAT = 1
+
+# ------------------------------------------------------------------------
+def find_status_dir(data):
+    # snapshot is stored in status_dir, but we want to know where it is without parsing whole configuration
+    section = None
+    for line in data.splitlines():
+        m = re.match(r"\[([^]]+)\]", line)
+        if m:
+            section = m.group(1)
+            continue
+        if section == "global":
+            m = re.match(r"status_dir\s*[:=]\s*(.*)$", line)
+            if m:
+                status_dir = m.group(1).strip()
+                # it's not the place to resolve variables
+                if status_dir.find("$") != -1:
+                    return None
+                return status_dir
+    return None
+
+# ------------------------------------------------------------------------
+def code_version():
+    # snapshot made by other code (eg. before upgrade) can't be trusted
+    try:
+        f = open(os.path.splitext(__file__)[0] + ".py", "rb")
+        try:
+            return hashlib.sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+    except:
+        return None
+
+# ------------------------------------------------------------------------
+def load_config(cfgfile):
+    # use compiled configuration snapshot if it's up to date, parse configuration file otherwise
+    f = open(cfgfile, "rb")
+    data = f.read()
+    f.close()
+
+    key = (SNAPSHOT_FORMAT, code_version(), os.stat(cfgfile).st_mtime, hashlib.sha1(data).hexdigest())
+
+    status_dir = find_status_dir(data)
+    if not status_dir:
+        return Config(cfgfile)
+
+    path = "%s/b1000-config-%s.snapshot" % (status_dir, hashlib.sha1(os.path.abspath(cfgfile)).hexdigest()[:12])
+
+    try:
+        f = open(path, "rb")
+        try:
+            (snapshot_key, cfg) = cPickle.load(f)
+        finally:
+            f.close()
+        if snapshot_key == key and isinstance(cfg, Config) and cfg.complete():
+            cfg.snapshot = (path, key)
+            return cfg
+    except:
+        pass
+
+    cfg = Config(cfgfile)
+    cfg.snapshot = (path, key)
+    return cfg
 
 # ------------------------------------------------------------------------
 class Config:
 
+    var_re = re.compile(r'\$[a-zA-Z][a-zA-Z0-9_]*')
+
     # --------------------------------------------------------------------
     def __init__(self, cfgfile):
         self.jobs = []
@@ -29,6 +102,20 @@ class Config:
         self.reports = []
         self.pulls = []
 
+        # output of dynamic options: expanded command -> output
+        self.exec_cache = {}
+        # resolved values: (section, option) -> (value, set of all options used to resolve it)
+        self.cache = {}
+        # reverse dependencies: (section, option) -> set of cached keys that used it
+        self.rdeps = {}
+        # sections that passed validation: (section, required, allowed)
+        self.validated = set()
+        self.lock = RLock()
+
+        # compiled snapshot location and key, see load_config()
+        self.snapshot = None
+        self.dirty = True
+
         self.cfg = ConfigParser.RawConfigParser()
 
         f_cfg = open(cfgfile)
@@ -53,9 +140,72 @@ class Config:
             for o in self.cfg.options(s):
                 print "   " + o + " = " + self.cfg.get(s, o)
 
+    # --------------------------------------------------------------------
+    def __getstate__(self):
+        # configuration gets pickled together with failed jobs and into
+        # snapshots, locks can't be, and output of dynamic options is valid
+        # only for one run
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['exec_cache']
+        return state
+
+    # --------------------------------------------------------------------
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+        self.exec_cache = {}
+        self.dirty = False
+
+    # --------------------------------------------------------------------
+    def complete(self):
+        # everything fresh configuration has, snapshot needs to have too
+        for a in ['jobs', 'destinations', 'reports', 'pulls', 'cache', 'rdeps', 'validated', 'snapshot', 'dirty', 'cfg']:
+            if not hasattr(self, a):
+                return False
+        return True
+
+    # --------------------------------------------------------------------
+    def save_snapshot(self):
+        # store parsed configuration together with all resolved values and validation results
+        if not self.snapshot or not self.dirty:
+            return
+
+        (path, key) = self.snapshot
+        tmp = "%s.%i" % (path, os.getpid())
+
+        self.lock.acquire()
+        try:
+            f = open(tmp, "wb")
+            try:
+                cPickle.dump((key, self), f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+            self.dirty = False
+        finally:
+            self.lock.release()
+
     # --------------------------------------------------------------------
     def set(self, section, option, value):
-        self.cfg.set(section, option, value)
+        self.lock.acquire()
+        try:
+            if self.cfg.has_option(section, option) and self.cfg.get(section, option) == value:
+                return
+            self.cfg.set(section, option, value)
+            # configuration doesn't match the file anymore
+            self.snapshot = None
+
+            # drop cached values resolved using this option
+            self.cache.pop((section, option), None)
+            for d in self.rdeps.pop((section, option), ()):
+                self.cache.pop(d, None)
+        finally:
+            self.lock.release()
+
+    # --------------------------------------------------------------------
+    def sections(self):
+        return self.cfg.sections()
 
     # --------------------------------------------------------------------
     def has_section(self, section):
@@ -70,55 +220,174 @@ class Config:
         return self.cfg.options(section)
 
     # --------------------------------------------------------------------
-    def get(self, section, option):
+    def get(self, section, option, view=None):
+        self.lock.acquire()
+        try:
+            return self.__resolve(section, option, [], view)[0]
+        finally:
+            self.lock.release()
 
-        value = self.cfg.get(section, option)
-        variables = re.findall(r'\$[a-zA-Z][a-zA-Z0-9_]*', value)
+    # --------------------------------------------------------------------
+    def __resolve(self, section, option, stack, view):
+        key = (section, option)
 
-        # try to substitute (recursively) each variable
-        for v in variables:
-            # search localy
+        # values that depend on run-time options of a view are cached in the view
+        if view is not None:
             try:
-                subst = self.get(section, v[1:])
-            except:
-                # search globaly
-                try:
-                    subst = self.get('global', v[1:])
-                except:
-                    raise ValueError("Undefined variable: %s" % v)
+                return view.cache[key]
+            except KeyError:
+                pass
 
-            value = value.replace(v, subst)
+        try:
+            (value, deps) = self.cache[key]
+            if view is None or not (deps & view.keys):
+                return (value, deps)
+        except KeyError:
+            pass
 
-        return value
+        if key in stack:
+            chain = " -> ".join(["%s:%s" % k for k in stack + [key]])
+            raise ValueError("Circular variable reference: %s" % chain)
+
+        if view is not None and key in view.keys:
+            value = view.runtime[option]
+        else:
+            value = self.cfg.get(section, option)
+
+        deps = set([key])
+
+        def has_option(s, o):
+            return self.cfg.has_option(s, o) or (view is not None and (s, o) in view.keys)
+
+        # substitute (recursively) each variable
+        def subst(m):
+            v = m.group(0)[1:]
+            # search localy
+            deps.add((section, v))
+            if has_option(section, v):
+                (value, vdeps) = self.__resolve(section, v, stack, view)
+                deps.update(vdeps)
+                return value
+            # search globaly
+            deps.add(('global', v))
+            if has_option('global', v):
+                (value, vdeps) = self.__resolve('global', v, stack, view)
+                deps.update(vdeps)
+                return value
+            raise ValueError("Undefined variable: $%s" % v)
+
+        stack.append(key)
+        try:
+            value = self.var_re.sub(subst, value)
+        finally:
+            stack.pop()
+
+        if view is not None and (deps & view.keys):
+            view.cache[key] = (value, deps)
+        else:
+            self.cache[key] = (value, deps)
+            for d in deps:
+                self.rdeps.setdefault(d, set()).add(key)
+            self.dirty = True
+
+        return (value, deps)
 
     # --------------------------------------------------------------------
-    def get_def(self, section, option, default):
+    def get_def(self, section, option, default, view=None):
         try:
-            value = self.get(section, option)
+            value = self.get(section, option, view)
         except:
             value = default
         return value
 
     # --------------------------------------------------------------------
-    def get_exec(self, section, option):
+    def __exec(self, cmd):
+        # each command is run at most once per program run (unless it fails)
+        self.lock.acquire()
+        try:
+            if cmd in self.exec_cache:
+                return self.exec_cache[cmd]
+        finally:
+            self.lock.release()
+
+        output = subprocess.check_output(cmd, shell=True)
 
-        value = self.get(section, option)
+        self.lock.acquire()
+        try:
+            self.exec_cache[cmd] = output
+        finally:
+            self.lock.release()
+
+        return output
+
+    # --------------------------------------------------------------------
+    def get_exec(self, section, option, view=None):
+
+        value = self.get(section, option, view)
 
         if value.startswith("!"):
-            value = subprocess.check_output(value[1:], shell=True)
+            value = self.__exec(value[1:])
 
         return value
 
     # --------------------------------------------------------------------
-    def get_exec_def(self, section, option, default):
+    def get_exec_def(self, section, option, default, view=None):
         try:
-            value = self.get_exec(section, option)
+            value = self.get_exec(section, option, view)
         except:
             value = default
         return value
 
+    # --------------------------------------------------------------------
+    def prefetch_exec(self, views, options=None, workers=8):
+        # run dynamic options concurrently, so later get_exec() calls are served from cache
+        # views is a list of ConfigView objects, one for each job section (and instance)
+        cmds = []
+
+        for v in views:
+            for o in self.cfg.options(v.section):
+                if options is not None and o not in options:
+                    continue
+                try:
+                    value = v.get(v.section, o)
+                except:
+                    continue
+                if value.startswith("!") and value[1:] not in self.exec_cache and value[1:] not in cmds:
+                    cmds.append(value[1:])
+
+        if not cmds:
+            return
+
+        q = Queue.Queue()
+        for c in cmds:
+            q.put(c)
+
+        def run():
+            while True:
+                try:
+                    cmd = q.get_nowait()
+                except Queue.Empty:
+                    return
+                # failed commands are not cached, they will fail (and get reported) when used
+                try:
+                    self.__exec(cmd)
+                except:
+                    pass
+
+        threads = []
+        for n in range(min(workers, len(cmds))):
+            t = Thread(target=run, name="Exec-%i" % n)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
     # --------------------------------------------------------------------
     def validate(self, section, required, allowed):
+        key = (section, tuple(required), tuple(allowed))
+        if key in self.validated:
+            return
+
         for r in required:
             if not self.cfg.has_option(section, r):
                 raise SyntaxError("Required parameter '%s' missing in section '%s'" % (r, section))
@@ -126,4 +395,79 @@ class Config:
             if (p not in allowed) and (p not in required):
                 raise SyntaxError("Parameter '%s' not allowed for section '%s'" % (p, section))
 
+        self.lock.acquire()
+        try:
+            self.validated.add(key)
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+# ------------------------------------------------------------------------
+class ConfigView:
+
+    # Run-time options (name, host, instance, start_time) of one job, layered
+    # over its section of the shared configuration. Configuration itself
+    # is never modified, so many jobs can be set up at the same time.
+
+    # --------------------------------------------------------------------
+    def __init__(self, cfg, section, runtime=None):
+        self.base = cfg
+        self.section = section
+        self.jobs = cfg.jobs
+        self.runtime = {}
+        self.keys = set()
+        # resolved values that depend on run-time options
+        self.cache = {}
+
+        if runtime:
+            for o, v in runtime.items():
+                self.set(section, o, v)
+
+    # --------------------------------------------------------------------
+    def set(self, section, option, value):
+        if section != self.section:
+            raise ValueError("Run-time option '%s' may be set only in section '%s'" % (option, self.section))
+        self.base.lock.acquire()
+        try:
+            self.runtime[option] = value
+            self.keys.add((section, option))
+            self.cache.clear()
+        finally:
+            self.base.lock.release()
+
+    # --------------------------------------------------------------------
+    def has_section(self, section):
+        return self.base.has_section(section)
+
+    # --------------------------------------------------------------------
+    def has_option(self, section, option):
+        return (section, option) in self.keys or self.base.has_option(section, option)
+
+    # --------------------------------------------------------------------
+    def options(self, section):
+        options = self.base.options(section)
+        if section == self.section:
+            options += [o for o in self.runtime if o not in options]
+        return options
+
+    # --------------------------------------------------------------------
+    def get(self, section, option):
+        return self.base.get(section, option, self)
+
+    # --------------------------------------------------------------------
+    def get_def(self, section, option, default):
+        return self.base.get_def(section, option, default, self)
+
+    # --------------------------------------------------------------------
+    def get_exec(self, section, option):
+        return self.base.get_exec(section, option, self)
+
+    # --------------------------------------------------------------------
+    def get_exec_def(self, section, option, default):
+        return self.base.get_exec_def(section, option, default, self)
+
+    # --------------------------------------------------------------------
+    def validate(self, section, required, allowed):
+        self.base.validate(section, required, allowed)
+
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -15,7 +15,10 @@
 # Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import os
 import time
+import tempfile
+import shutil
 import logging as l
 
 from threading import Thread
@@ -23,10 +26,17 @@ from Queue import Queue
 
 from dispatcher import Dispatcher
 from bjob import Job
+from bdest import dest_slots, DestRsync
+from butils import run_to_files
 
 # ------------------------------------------------------------------------
 class CopyDispatcher(Dispatcher):
 
+    # --------------------------------------------------------------------
+    def priority(self, job):
+        # longest copies start first
+        return -self.plan.copy_time(job.real_name, job.instance)
+
     # --------------------------------------------------------------------
     def process(self, job):
         l.debug("Dispatching job '%s' for Copy" % job.full_name)
@@ -35,21 +45,66 @@ class CopyDispatcher(Dispatcher):
 
         job.set_step(Job.JOB_STEP_COPYING)
 
-        # spawn copy jobs
+        # pre script output is produced once, for all destinations
+        if job.stream:
+            self.__produce_stream(job)
+
+        # fan-out: changes are computed once, against the first destination, and applied to the others
+        # that are known to hold the same data
+        batch_dir = None
+        fan_out = []
+        if job.fan_out and not job.stream:
+            fan_out = [d for d in job.dest if d.status == Job.COPY_STATUS_INIT and isinstance(d, DestRsync)]
+        if len(fan_out) > 1:
+            batch_dir = tempfile.mkdtemp(prefix="b1000-batch-", dir=job.backup_dir)
+            self.__write_batch(fan_out, batch_dir + "/batch")
+        else:
+            fan_out = []
+
+        # group destinations as configured (destinations joined with '/' form one group)
+        groups = []
         for dest in job.dest:
+            # destination that has written the batch is done for now, whatever happened
+            if fan_out and dest is fan_out[0]:
+                continue
             # don't try to reprocess DONE nor FAILED (permanently) destinations
             if dest.status != Job.COPY_STATUS_DONE and dest.status != Job.COPY_STATUS_FAILED:
-                c = Copy(dest)
-                c.start()
-                if dest.bg:
-                    bg_copies.append(c)
+                if groups and groups[-1][0].group == dest.group:
+                    groups[-1].append(dest)
                 else:
+                    groups.append([dest])
+
+        # spawn copy jobs
+        for group in groups:
+            # background copies wait for their destination slots by themselves
+            if group[0].bg:
+                for dest in group:
+                    c = Copy(dest)
+                    c.start()
+                    bg_copies.append(c)
+            # foreground copies go one by one, to whichever destination in group is free first
+            else:
+                pending = list(group)
+                while pending:
+                    dest = dest_slots.acquire(pending)
+                    pending.remove(dest)
+                    c = Copy(dest, True)
+                    c.start()
                     c.join()
 
         # wait for background copies to finish
         for bgc in bg_copies:
             bgc.join()
 
+        if batch_dir is not None:
+            # all destinations copied by this fan-out hold the same data now, whichever way they got it
+            mark = "%s %.6f" % (job.full_name, time.time())
+            for dest in fan_out:
+                dest.batch = None
+                if dest.status == Job.COPY_STATUS_DONE:
+                    dest.set_sync_mark(mark)
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
         # check dest statuses
         permanent_fail = False
         temporary_fail = False
@@ -59,6 +114,12 @@ class CopyDispatcher(Dispatcher):
             if dest.status == Job.COPY_STATUS_WARNING:
                 temporary_fail = True
 
+        # staged pre script output is kept only for destinations that will retry
+        if job.stream_dir is not None and not temporary_fail:
+            shutil.rmtree(job.stream_dir, ignore_errors=True)
+            job.stream_dir = None
+            job.stream_file = None
+
         # something to retry
         if temporary_fail:
             l.info("Putting job '%s' back to copy queue, will retry in %i seconds" % (job.full_name, job.copy_retry_min_sleep))
@@ -80,18 +141,114 @@ class CopyDispatcher(Dispatcher):
                 job.write_state()
 
 
+    # --------------------------------------------------------------------
+    def __produce_stream(self, job):
+        dests = [d for d in job.dest if d.status != Job.COPY_STATUS_DONE and d.status != Job.COPY_STATUS_FAILED]
+        if not dests:
+            return
+
+        outputs = []
+        local = []
+        for dest in dests:
+            output = dest.stream_output()
+            if output is None:
+                if job.stream_dir is None:
+                    job.stream_dir = tempfile.mkdtemp(prefix="b1000-stream-", dir=job.backup_dir)
+                    job.stream_file = job.stream_dir + "/" + job.stream
+                output = job.stream_file
+            else:
+                local.append((dest, output))
+            if output not in outputs:
+                outputs.append(output)
+
+        # output left by previous copy attempt is still there, no need to run pre script again
+        missing = [o for o in outputs if not os.path.exists(o)]
+        if not missing:
+            return
+
+        # writing to local destination is copying there, it takes destination slot as any copy does
+        # (slots are always taken in the same order, so producers of many jobs can't deadlock)
+        local.sort(key=lambda (dest, output): dest.name)
+        for dest, output in local:
+            dest_slots.acquire([dest])
+
+        try:
+            for dest, output in local:
+                try:
+                    dest.prepare_stream()
+                except Exception, e:
+                    # destination will fail to copy without the output (and retry as usual)
+                    l.warning("Cannot prepare destination '%s' for pre script output. Exception: %s" % (dest.name, str(e)))
+                    outputs.remove(output)
+            if not outputs:
+                return
+
+            l.info("Running pre script '%s' for job '%s', output goes to %i file(s)" % (job.pre, job.full_name, len(outputs)))
+            try:
+                run_to_files(job.pre, outputs, name=job.full_name)
+            except Exception, e:
+                l.error("Pre script '%s' for job '%s' failed. Exception: %s" % (job.pre, job.full_name, str(e)))
+                for o in outputs:
+                    try:
+                        os.unlink(o)
+                    except OSError:
+                        pass
+        finally:
+            for dest, output in local:
+                dest_slots.release(dest)
+
+    # --------------------------------------------------------------------
+    def __write_batch(self, dests, batch):
+        first = dests[0]
+
+        # changes computed against the first destination can't be applied to a destination holding different data
+        # (rsync would skip files that differ), so batch is used only for destinations in sync with the first one
+        state = first.sync_state()
+        in_sync = []
+        for dest in dests[1:]:
+            if state is not None and dest.sync_state() == state:
+                in_sync.append(dest)
+            else:
+                l.info("Destination '%s' is not known to be in sync with '%s', job '%s' will be copied there the usual way" % (dest.name, first.name, first.job.full_name))
+
+        l.info("Copying job '%s' to destination '%s' first, changes will be applied to %i other destination(s)" % (first.job.full_name, first.name, len(in_sync)))
+
+        first.batch = ('write', batch)
+        c = Copy(first)
+        c.start()
+        c.join()
+        first.batch = None
+
+        if first.status == Job.COPY_STATUS_DONE:
+            for dest in in_sync:
+                dest.batch = ('read', batch)
+        else:
+            l.warning("Could not prepare changes for job '%s' on destination '%s', copying to other destinations separately" % (first.job.full_name, first.name))
+
+
 # ------------------------------------------------------------------------
 class Copy(Thread):
 
     # --------------------------------------------------------------------
-    def __init__(self, dest):
+    def __init__(self, dest, has_slot=False):
         l.debug("Initializing thread to copy job '%s' to destination '%s'" % (dest.job.full_name, dest.name))
         Thread.__init__(self, name="Copy")
         self.dest = dest
+        self.has_slot = has_slot
 
     # --------------------------------------------------------------------
     def run(self):
 
+        if not self.has_slot:
+            dest_slots.acquire([self.dest])
+
+        try:
+            self.copy()
+        finally:
+            dest_slots.release(self.dest)
+
+    # --------------------------------------------------------------------
+    def copy(self):
         l.info("Copying: %s -> %s (background: %s)" % (self.dest.job.full_name, self.dest.name, str(self.dest.bg)))
 
         try:
@@ -17,12 +17,76 @@
 
 import logging as l
 
+import re
 import time
 import os
 import os.path
-import glob
+import json
+import pipes
 
-from rsync import Rsync
+from threading import Thread, Condition
+from rsync import Rsync, PROFILES
+from binotify import wait_for_files
+
+# ------------------------------------------------------------------------
+class DestSlots:
+
+    # --------------------------------------------------------------------
+    def __init__(self):
+        self.cv = Condition()
+        self.used = {}
+
+    # --------------------------------------------------------------------
+    def __free(self, dest):
+        if dest.max_concurrent <= 0:
+            return True
+        return self.used.get(dest.name, 0) < dest.max_concurrent
+
+    # --------------------------------------------------------------------
+    def acquire(self, dests):
+        # wait for a free slot on any of given destinations (first free one wins)
+        # returns destination for which the slot has been taken
+        self.cv.acquire()
+        try:
+            waiting = False
+            while True:
+                for d in dests:
+                    if self.__free(d):
+                        self.used[d.name] = self.used.get(d.name, 0) + 1
+                        return d
+                if not waiting:
+                    l.debug("Waiting for a free slot on destination(s): %s" % ", ".join([d.name for d in dests]))
+                    waiting = True
+                self.cv.wait()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def acquire_extra(self, dest, count):
+        # take up to count more slots on destination, only those that are free right now
+        # (waiting for more while holding one could deadlock copies)
+        # returns number of slots taken
+        self.cv.acquire()
+        try:
+            taken = 0
+            while taken < count and self.__free(dest):
+                self.used[dest.name] = self.used.get(dest.name, 0) + 1
+                taken += 1
+            return taken
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def release(self, dest, count=1):
+        self.cv.acquire()
+        try:
+            self.used[dest.name] -= count
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
+
+# copy slots for all destinations, shared by all jobs
+dest_slots = DestSlots()
 
 # ------------------------------------------------------------------------
 def dest_generator(job, cfg, name, bg):
@@ -48,9 +112,13 @@ class Dest:
         self.name = name
         self.sname = "dest:" + name
         self.bg = bg
+        self.group = None # filled in by the job, destinations joined with '/' share one group
         self.cfg = cfg
         self.type = cfg.get(self.sname, "type")
         self.cfg.validate(self.sname, self.params_required, self.params_allowed)
+        self.max_concurrent = int(cfg.get_def(self.sname, "max_concurrent", "0"))
+        self.profile = '' # transfer profile used for the last copy
+        self.stats = {} # transfer statistics of the last copy
  
     # --------------------------------------------------------------------
     def set_status(self, status):
@@ -67,7 +135,10 @@ class Dest:
 class DestRsync(Dest):
 
     params_required = ['type', 'path']
-    params_allowed = ['verbosity', 'exclude']
+    params_allowed = ['verbosity', 'exclude', 'max_concurrent', 'link_dest', 'profile', 'compress_level', 'output_sample', 'output_dir', 'parallel_streams']
+
+    # transfers to rsync:// destinations faster than this (bytes/s) go without compression
+    LAN_RATE = 10 * 1024 * 1024
 
     # --------------------------------------------------------------------
     def __init__(self, job, cfg, name, bg):
@@ -78,8 +149,38 @@ class DestRsync(Dest):
         self.exclude = cfg.get_def(self.sname, "exclude", "")
         self.verbosity = int(cfg.get_def(self.sname, "verbosity", "1"))
 
+        # rsync output: every output_sample-th line is logged, all of it goes to a file in output_dir
+        self.output_sample = int(cfg.get_def(self.sname, "output_sample", "1"))
+        self.output_file = None
+        output_dir = cfg.get_def(self.sname, "output_dir", "")
+        if output_dir:
+            start_time = time.strftime("%Y-%m-%d-%H-%M-%S", job.start_time)
+            self.output_file = output_dir + "/" + job.host + "-" + job.real_name + "-" + job.instance + "-" + name + "-" + start_time + ".log"
+
         self.path = self.__prepare_path()
 
+        # full backups hard-link files that didn't change since the last one
+        self.link_dest = cfg.get_def(self.sname, "link_dest", "yes") == "yes" and getattr(job, 'type', None) == 'full' and not job.stream
+        self.link_file = job.status_dir + "/" + job.host + "-" + job.real_name + "-" + job.instance + "-" + name + ".linkbase"
+
+        # ('write', file) or ('read', file) when changes are copied to many destinations at once
+        self.batch = None
+        # destinations with the same mark got the same changes on the last fan-out (see: sync_state)
+        self.sync_file = job.status_dir + "/" + job.host + "-" + job.real_name + "-" + job.instance + "-" + name + ".sync"
+
+        # transfer profile: local, lan, wan, or auto to pick one by destination path and throughput of previous copies
+        self.profile_option = cfg.get_def(self.sname, "profile", "auto")
+        if self.profile_option != 'auto' and self.profile_option not in PROFILES:
+            raise SyntaxError("Unknown transfer profile '%s' for destination '%s'" % (self.profile_option, name))
+        self.compress_level = None
+        if cfg.has_option(self.sname, "compress_level"):
+            self.compress_level = int(cfg.get(self.sname, "compress_level"))
+        self.rate_file = job.status_dir + "/b1000-dest-" + name + ".rate"
+
+        # include split into this many parts, copied by separate rsyncs at the same time
+        self.parallel_streams = int(cfg.get_def(self.sname, "parallel_streams", cfg.get_def(job.name, "parallel_streams", "1")))
+        self.weights_file = job.status_dir + "/" + job.host + "-" + job.real_name + "-" + job.instance + "-" + name + ".weights"
+
         self.retries = int(cfg.get_def("global", "copy_retries", '3'))
         self.retry_sleep = int(cfg.get_def("global", "copy_retries", '60'))
 
@@ -90,18 +191,353 @@ class DestRsync(Dest):
         if not path.endswith("/"):
             path += "/"
 
-        path += self.job.get_job_path()
+        self.job_path = self.job.get_job_path()
+        path += self.job_path
 
         return path
 
+    # --------------------------------------------------------------------
+    def __get_link_base(self):
+        # last successful backup, relative to this one (so it works for rsync:// destinations too)
+        try:
+            f = open(self.link_file)
+            path, job_path = f.read().split("\n")[:2]
+            f.close()
+        except Exception, e:
+            l.debug("No previous backup to link to on destination '%s'" % self.name)
+            return None
+
+        if path != self.cfg.get(self.sname, "path") or job_path == self.job_path:
+            return None
+
+        return os.path.relpath(job_path, self.job_path) + "/"
+
+    # --------------------------------------------------------------------
+    def __set_link_base(self):
+        try:
+            tmp = self.link_file + ".tmp"
+            f = open(tmp, "w")
+            f.write("%s\n%s\n" % (self.cfg.get(self.sname, "path"), self.job_path))
+            f.close()
+            os.rename(tmp, self.link_file)
+        except Exception, e:
+            l.warning("Could not write '%s', next backup won't be linked to this one. Exception: %s" % (self.link_file, str(e)))
+
+    # --------------------------------------------------------------------
+    def sync_state(self):
+        # mark of the last fan-out that has copied to this destination (and what it links to),
+        # destinations with the same state hold the same data
+        try:
+            f = open(self.sync_file)
+            path, mark = f.read().split("\n")[:2]
+            f.close()
+        except Exception, e:
+            return None
+
+        if path != self.cfg.get(self.sname, "path") or not mark:
+            return None
+
+        link_base = None
+        if self.link_dest:
+            link_base = self.__get_link_base()
+        return (mark, link_base)
+
+    # --------------------------------------------------------------------
+    def set_sync_mark(self, mark):
+        try:
+            tmp = self.sync_file + ".tmp"
+            f = open(tmp, "w")
+            f.write("%s\n%s\n" % (self.cfg.get(self.sname, "path"), mark))
+            f.close()
+            os.rename(tmp, self.sync_file)
+        except Exception, e:
+            l.warning("Could not write '%s', next fan-out will copy to destination '%s' the usual way. Exception: %s" % (self.sync_file, self.name, str(e)))
+
+    # --------------------------------------------------------------------
+    def clear_sync_mark(self):
+        # data is about to change, destination is in sync with others only after it's copied by fan-out
+        if os.path.exists(self.sync_file):
+            os.remove(self.sync_file)
+
     # --------------------------------------------------------------------
     def copy(self):
+        if self.job.fan_out:
+            self.clear_sync_mark()
+
+        if self.job.stream:
+            self.retries -= 1
+            self.__copy_stream()
+            return
+
+        link_base = None
+        if self.link_dest:
+            link_base = self.__get_link_base()
+
+        if self.batch is not None and self.batch[0] == 'read':
+            try:
+                self.__read_batch(self.batch[1], link_base)
+            except Exception, e:
+                l.warning("Could not apply changes to destination '%s', copying the usual way. Exception: %s" % (self.name, str(e)))
+            else:
+                self.retries -= 1
+                if self.link_dest:
+                    self.__set_link_base()
+                return
+
         excludes = self.job.exclude + " " + self.exclude
+
+        # batch is written by one rsync
+        units = None
+        if self.parallel_streams > 1 and self.batch is None:
+            units = self.__units()
+        # each rsync stream takes a destination slot (copy already holds one)
+        extra = 0
+        if units and len(units) > 1:
+            extra = dest_slots.acquire_extra(self, min(self.parallel_streams, len(units)) - 1)
+            if not extra:
+                l.debug("No free slots for more rsync streams on destination '%s', copying with one" % self.name)
+        if extra:
+            self.retries -= 1
+            try:
+                self.__copy_parallel(units, excludes, link_base, extra + 1)
+            finally:
+                dest_slots.release(self, extra)
+            self.__update_rate()
+            if self.link_dest:
+                self.__set_link_base()
+            return
+
         l.debug("Copying '%s' to '%s' on destination '%s' excluding: '%s'" % (self.job.include, self.path, self.name, excludes))
-        self.rsync = Rsync(self.name, self.job.include, self.path, excludes)
-        self.rsync.set_verbosity(self.verbosity)
+        self.rsync = self.__rsync(self.job.include, self.path, excludes)
+
+        if link_base:
+            l.debug("Hard-linking unchanged files to '%s' on destination '%s'" % (link_base, self.name))
+            self.rsync.add_opts(["link-dest='%s'" % link_base])
+
+        if self.batch is not None and self.batch[0] == 'write':
+            l.debug("Writing changes for other destinations to '%s'" % self.batch[1])
+            self.rsync.add_opts(["write-batch='%s'" % self.batch[1]])
+
         self.retries -= 1
-        self.rsync.run()
+        try:
+            self.rsync.run()
+        finally:
+            self.stats = self.rsync.stats
+        self.__update_rate()
+
+        if self.link_dest:
+            self.__set_link_base()
+
+    # --------------------------------------------------------------------
+    def __units(self):
+        # parts of include that can be copied separately (contents of directories
+        # given with trailing '/' are split), None if include can't be split
+        units = []
+        for i in self.job.include.split(" "):
+            if not i:
+                continue
+            # remote sources and wildcards are left to rsync
+            if not i.startswith("/") or re.search("[*?\[]", i):
+                return None
+            if i.endswith("/") and os.path.isdir(i):
+                units += [i + e for e in sorted(os.listdir(i))]
+            else:
+                units.append(i)
+        return units
+
+    # --------------------------------------------------------------------
+    def __load_weights(self):
+        try:
+            f = open(self.weights_file)
+            weights = json.load(f)
+            f.close()
+            return weights
+        except Exception, e:
+            return {}
+
+    # --------------------------------------------------------------------
+    def __save_weights(self, weights):
+        try:
+            tmp = self.weights_file + ".tmp"
+            f = open(tmp, "w")
+            json.dump(weights, f)
+            f.close()
+            os.rename(tmp, self.weights_file)
+        except Exception, e:
+            l.warning("Could not write '%s'. Exception: %s" % (self.weights_file, str(e)))
+
+    # --------------------------------------------------------------------
+    def __partition(self, units, weights, default, count):
+        # biggest first, each to the lightest partition
+        parts = [[] for i in range(min(count, len(units)))]
+        totals = [0.0] * len(parts)
+        for u in sorted(units, key=lambda u: -weights.get(u, default)):
+            i = totals.index(min(totals))
+            parts[i].append(u)
+            totals[i] += weights.get(u, default)
+        return parts
+
+    # --------------------------------------------------------------------
+    def __run_stream(self, rsync, errors):
+        try:
+            rsync.run()
+        except Exception, e:
+            errors.append(str(e))
+
+    # --------------------------------------------------------------------
+    def __copy_parallel(self, units, excludes, link_base, count):
+        # weights (number of files) come from previous copies, unknown parts weigh as much as an average one
+        weights = self.__load_weights()
+        known = [weights[u] for u in units if u in weights]
+        default = 1.0
+        if known:
+            default = sum(known) / len(known)
+
+        parts = self.__partition(units, weights, default, count)
+        l.info("Copying '%s' to destination '%s' with %i rsync streams" % (self.job.include, self.name, len(parts)))
+
+        streams = []
+        errors = []
+        for i in range(len(parts)):
+            rsync = self.__rsync(" ".join([pipes.quote(u) for u in parts[i]]), self.path, excludes)
+            if link_base:
+                rsync.add_opts(["link-dest='%s'" % link_base])
+            if self.output_file:
+                rsync.set_output(self.output_sample, "%s.%i" % (self.output_file, i))
+            t = Thread(target=self.__run_stream, args=(rsync, errors), name="Copy-%i" % i)
+            streams.append((rsync, t))
+
+        # destination directory is created once, not by all streams at the same time
+        try:
+            streams[0][0].mkdir(self.path)
+        except Exception, e:
+            raise OSError("Could not create directory '%s'. Exception: %s" % (self.path, str(e)))
+
+        for rsync, t in streams:
+            t.start()
+        for rsync, t in streams:
+            t.join()
+
+        # one copy result from all streams
+        self.stats = {}
+        for rsync, t in streams:
+            for k, v in rsync.stats.items():
+                if k == 'elapsed':
+                    self.stats[k] = max(v, self.stats.get(k, 0))
+                else:
+                    self.stats[k] = self.stats.get(k, 0) + v
+
+        # spread files counted by each stream over its parts, in proportion to their weights
+        for i in range(len(parts)):
+            files = streams[i][0].stats.get('files')
+            used = sum([weights.get(u, default) for u in parts[i]])
+            if files is None or used <= 0:
+                continue
+            for u in parts[i]:
+                weights[u] = weights.get(u, default) * files / used
+        self.__save_weights(dict([(u, weights[u]) for u in units if u in weights]))
+
+        if errors:
+            raise OSError("%i of %i rsync streams failed: %s" % (len(errors), len(parts), "; ".join(errors)))
+
+    # --------------------------------------------------------------------
+    def __get_rate(self):
+        try:
+            f = open(self.rate_file)
+            rate = float(f.read())
+            f.close()
+            return rate
+        except Exception, e:
+            return None
+
+    # --------------------------------------------------------------------
+    def __update_rate(self):
+        # only transfers over network, big enough, say anything about the link
+        s = self.stats
+        if self.path.startswith("/") or 'rate' not in s or s.get('bytes_sent', 0) + s.get('bytes_received', 0) < 1024 * 1024:
+            return
+
+        rate = s['rate']
+        old = self.__get_rate()
+        if old is not None:
+            rate = (old + rate) / 2
+        try:
+            tmp = self.rate_file + ".tmp"
+            f = open(tmp, "w")
+            f.write("%.0f\n" % rate)
+            f.close()
+            os.rename(tmp, self.rate_file)
+        except Exception, e:
+            l.warning("Could not write '%s'. Exception: %s" % (self.rate_file, str(e)))
+
+    # --------------------------------------------------------------------
+    def __choose_profile(self):
+        if self.profile_option != 'auto':
+            return self.profile_option
+        if self.path.startswith("/"):
+            return 'local'
+        rate = self.__get_rate()
+        if rate is not None and rate >= self.LAN_RATE:
+            return 'lan'
+        return 'wan'
+
+    # --------------------------------------------------------------------
+    def __rsync(self, src, dst, exclude):
+        self.profile = self.__choose_profile()
+        l.debug("Using transfer profile '%s' for destination '%s'" % (self.profile, self.name))
+        rsync = Rsync(self.name, src, dst, exclude)
+        rsync.set_verbosity(self.verbosity)
+        rsync.set_output(self.output_sample, self.output_file)
+        rsync.set_profile(self.profile, self.compress_level)
+        # transfer statistics for reports
+        rsync.add_opts(["stats"])
+        return rsync
+
+    # --------------------------------------------------------------------
+    def __read_batch(self, batch, link_base):
+        l.debug("Applying changes from '%s' to '%s' on destination '%s'" % (batch, self.path, self.name))
+        self.rsync = self.__rsync("", self.path, "")
+        if link_base:
+            self.rsync.add_opts(["link-dest='%s'" % link_base])
+        self.rsync.add_opts(["read-batch='%s'" % batch])
+        try:
+            self.rsync.run()
+        finally:
+            self.stats = self.rsync.stats
+
+    # --------------------------------------------------------------------
+    def stream_output(self):
+        # where pre script output for this destination goes, None if it needs
+        # a file staged in backup_dir (rsync can't read data from a pipe)
+        if not self.path.startswith("/"):
+            return None
+        return self.path + self.job.stream + ".part"
+
+    # --------------------------------------------------------------------
+    def prepare_stream(self):
+        if self.path.startswith("/") and not os.path.isdir(self.path):
+            l.debug("Creating local subdirectories: '%s'" % self.path)
+            os.makedirs(self.path)
+
+    # --------------------------------------------------------------------
+    def __copy_stream(self):
+        # pre script output is already there (see: CopyDispatcher), it only needs to be put in place
+        if self.path.startswith("/"):
+            target = self.path + self.job.stream
+            if not os.path.exists(target + ".part"):
+                raise OSError("Output of pre script '%s' is not available" % self.job.pre)
+            os.rename(target + ".part", target)
+            l.info("Pre script output stored in '%s' on destination '%s'" % (target, self.name))
+
+        else:
+            if self.job.stream_file is None or not os.path.exists(self.job.stream_file):
+                raise OSError("Output of pre script '%s' is not available" % self.job.pre)
+            self.rsync = self.__rsync(self.job.stream_file, self.path, "")
+            try:
+                self.rsync.run()
+            finally:
+                self.stats = self.rsync.stats
+            self.__update_rate()
 
 
 # ------------------------------------------------------------------------
@@ -133,32 +569,27 @@ class DestPassive(Dest):
         status_files = self.job.report_dir + "/" + self.job.real_name + "-" + self.job.instance + "-" + start_time + ".b1k." + self.host + ".*"
         
         l.debug("Waiting for files matching '%s' (with timeout of %i seconds)" % (status_files, self.timeout))
-        wait_started = time.time()
-
-        while True:
-
-            files = glob.glob(status_files)
-            if files:
-                for f in files:
-
-                    # remove the status file, we don't need it anymore
-                    try:
-                        os.remove(f)
-                    except Exception, e:
-                        l.warning("Could not remove status file '%s'" % f)
-
-                    # check the remote status
-                    if f.endswith(".error"):
-                        raise RuntimeError("Remote job returned 'ERROR'")
-                    elif f.endswith(".done"):
-                        l.debug("Remote job returned 'DONE'")
-                    else:
-                        l.warning("Remote job wrote file with unknown status: %s" % f)
-                break
-
-            if time.time() - wait_started > self.timeout:
-                raise RuntimeError("Timeout while waiting for host '%s' to pull data from destination '%s'" % (self.host, self.name))
-            time.sleep(1)
+
+        files = wait_for_files(status_files, self.timeout)
+        if not files:
+            raise RuntimeError("Timeout while waiting for host '%s' to pull data from destination '%s'" % (self.host, self.name))
+
+        for f in files:
+
+            # remove the status file, we don't need it anymore
+            try:
+                os.remove(f)
+            except Exception, e:
+                l.warning("Could not remove status file '%s'" % f)
+
+            # check the remote status
+            if f.endswith(".error"):
+                raise RuntimeError("Remote job returned 'ERROR'")
+            elif f.endswith(".done"):
+                l.debug("Remote job returned 'DONE'")
+            else:
+                l.warning("Remote job wrote file with unknown status: %s" % f)
+
 
 
 
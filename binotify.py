@@ -0,0 +1,118 @@
+# Copyright (c) 2012 Jakub Filipowicz <jakubf@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import glob
+import errno
+import select
+import logging as l
+
+IN_CREATE = 0x00000100
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# longest we sleep without looking at the files (events may get lost, eg. on NFS)
+MAX_WAIT = 60
+
+libc = None
+
+# --------------------------------------------------------------------
+def get_libc():
+    global libc
+    if libc is None:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    return libc
+
+# ------------------------------------------------------------------------
+class Inotify:
+
+    # Linux inotify watch on a single directory, woken up when files
+    # are created, written or moved into it.
+
+    # --------------------------------------------------------------------
+    def __init__(self, path, mask=IN_CREATE|IN_CLOSE_WRITE|IN_MOVED_TO):
+        import ctypes
+        c = get_libc()
+
+        self.fd = c.inotify_init()
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "inotify_init() failed: %s" % os.strerror(e))
+
+        if c.inotify_add_watch(self.fd, path, mask) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, "inotify_add_watch() failed for '%s': %s" % (path, os.strerror(e)))
+
+    # --------------------------------------------------------------------
+    def wait(self, timeout):
+        # returns True if something happened in the directory within timeout
+        try:
+            r, w, x = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return False
+            raise
+        if not r:
+            return False
+
+        # we only care that something happened, not what exactly
+        os.read(self.fd, 65536)
+        return True
+
+    # --------------------------------------------------------------------
+    def close(self):
+        os.close(self.fd)
+
+# --------------------------------------------------------------------
+def wait_for_files(pattern, timeout):
+    # returns files matching glob pattern as soon as there are any,
+    # or empty list after timeout
+
+    watch = None
+    try:
+        watch = Inotify(os.path.dirname(pattern))
+    except Exception, e:
+        l.debug("Cannot watch directory of '%s', polling for files instead. Exception: %s" % (pattern, str(e)))
+
+    wait_started = time.time()
+
+    try:
+        while True:
+            # watch is already set up, so nothing gets created unnoticed between glob() and wait()
+            files = glob.glob(pattern)
+            if files:
+                return files
+
+            remaining = timeout - (time.time() - wait_started)
+            if remaining <= 0:
+                return []
+
+            if watch is not None:
+                watch.wait(min(remaining, MAX_WAIT))
+            else:
+                time.sleep(min(remaining, 1))
+    finally:
+        if watch is not None:
+            watch.close()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -26,8 +26,13 @@ import tempfile
 import shutil
 import ConfigParser
 import glob
+import fnmatch
+import hashlib
+
+from threading import Thread, Lock, Condition
 
 from rsync import Rsync
+from bconfig import ConfigView
 from breport import ReportMysql, ReportFile, Values
 from bdest import Dest, dest_generator
 from butils import get_lock, release_lock
@@ -35,6 +40,273 @@ from butils import get_lock, release_lock
 class NoReportException(BaseException):
     pass
 
+# --------------------------------------------------------------------
+class RemoteReportCache:
+
+    # Local copies of remote reports, kept between fetches, so rsync
+    # transfers only reports that have changed.
+
+    # --------------------------------------------------------------------
+    def __init__(self):
+        self.dir = None
+        self.fetched = set() # report sources with all reports we need already fetched
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def get_dir(self, report_source):
+        self.lock.acquire()
+        try:
+            if self.dir is None:
+                self.dir = tempfile.mkdtemp(prefix="b1000-remote-report-")
+            d = self.dir + "/" + hashlib.md5(report_source).hexdigest()
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            return d
+        finally:
+            self.lock.release()
+
+    # --------------------------------------------------------------------
+    def prefetch(self, report_source, patterns):
+        # fetch reports for all jobs using this report source with one rsync
+        l.debug("Fetching %i report(s) from '%s'" % (len(patterns), report_source))
+        rsync = Rsync("remote_report", report_source + "/", self.get_dir(report_source), "*")
+        rsync.set_include(patterns)
+        rsync.run()
+        self.lock.acquire()
+        try:
+            self.fetched.add(report_source)
+        finally:
+            self.lock.release()
+
+    # --------------------------------------------------------------------
+    def find(self, report_source, pattern):
+        # returns prefetched report (and its file name) or None if report source wasn't prefetched
+        self.lock.acquire()
+        try:
+            if report_source not in self.fetched:
+                return None
+        finally:
+            self.lock.release()
+
+        d = self.get_dir(report_source)
+        try:
+            report_file = sorted(fnmatch.filter(os.listdir(d), pattern))[-1]
+            report = ConfigParser.RawConfigParser()
+            f = open(d + "/" + report_file)
+            report.readfp(f)
+            f.close()
+        except Exception, e:
+            raise NoReportException("Could not read report file '%s'. Exception: %s" % (report_source + "/" + pattern, str(e)))
+
+        return report, report_file
+
+    # --------------------------------------------------------------------
+    def cleanup(self):
+        self.lock.acquire()
+        try:
+            if self.dir is not None:
+                shutil.rmtree(self.dir, ignore_errors=True)
+                self.dir = None
+                self.fetched.clear()
+        finally:
+            self.lock.release()
+
+remote_reports = RemoteReportCache()
+
+# --------------------------------------------------------------------
+class RemoteNotifier(Thread):
+
+    # Sends notifications (empty marker files) to one report source.
+    # Notifications that come in while one transfer is being prepared
+    # or sent go together with the next one. Notifications that could
+    # not be sent are retried with the next transfer.
+
+    # --------------------------------------------------------------------
+    def __init__(self, report_source, interval, retries):
+        Thread.__init__(self, name="Notify-" + report_source)
+        # notifier that can't get through doesn't keep the process alive, see: stop()
+        self.daemon = True
+        self.report_source = report_source
+        self.interval = interval
+        self.retries = retries
+        self.cv = Condition()
+        self.pending = set()
+        # failed transfers for each pending marker
+        self.attempts = {}
+        # final result for each marker: None if sent, error message otherwise
+        self.results = {}
+        self.fin = False
+
+    # --------------------------------------------------------------------
+    def submit(self, marker):
+        self.cv.acquire()
+        try:
+            self.pending.add(marker)
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def wait(self, marker):
+        # wait until marker is sent, raise if it can't be
+        self.cv.acquire()
+        try:
+            while marker not in self.results:
+                self.cv.wait()
+            error = self.results[marker]
+        finally:
+            self.cv.release()
+        if error is not None:
+            raise RuntimeError("Could not send notification '%s' to remote '%s'. Exception: %s" % (marker, self.report_source, error))
+
+    # --------------------------------------------------------------------
+    def stop(self):
+        self.cv.acquire()
+        try:
+            self.fin = True
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def run(self):
+        while True:
+            self.cv.acquire()
+            try:
+                while not self.pending and not self.fin:
+                    self.cv.wait()
+                if not self.pending:
+                    break
+
+                # let more notifications come in
+                deadline = time.time() + self.interval
+                while not self.fin:
+                    now = time.time()
+                    if now >= deadline:
+                        break
+                    self.cv.wait(deadline - now)
+
+                markers = self.pending
+                self.pending = set()
+            finally:
+                self.cv.release()
+
+            try:
+                self.__send(markers)
+            except Exception, e:
+                self.__failed(markers, str(e))
+            else:
+                self.__finish(markers, None)
+
+    # --------------------------------------------------------------------
+    def __failed(self, markers, error):
+        self.cv.acquire()
+        try:
+            retry = set()
+            for m in markers:
+                self.attempts[m] = self.attempts.get(m, 0) + 1
+                if self.attempts[m] < self.retries:
+                    retry.add(m)
+            self.pending |= retry
+        finally:
+            self.cv.release()
+
+        if retry:
+            l.warning("Could not send %i notification(s) to remote '%s', will retry. Exception: %s" % (len(retry), self.report_source, error))
+        if len(retry) < len(markers):
+            l.error("Could not send %i notification(s) to remote '%s', giving up. Exception: %s" % (len(markers) - len(retry), self.report_source, error))
+            self.__finish(markers - retry, error)
+
+    # --------------------------------------------------------------------
+    def __finish(self, markers, error):
+        self.cv.acquire()
+        try:
+            for m in markers:
+                self.attempts.pop(m, None)
+                self.results[m] = error
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def __send(self, markers):
+        l.debug("Sending %i notification(s) to remote '%s'" % (len(markers), self.report_source))
+
+        tmpdir = tempfile.mkdtemp(prefix="b1000-remote-notify-")
+
+        try:
+            # prepare message files
+            for m in markers:
+                open(tmpdir + "/" + m, "w").close()
+
+            # rsync them all at once
+            rsync = Rsync("remote_notify", tmpdir + "/", self.report_source, "")
+            rsync.run()
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+# --------------------------------------------------------------------
+class RemoteNotifiers:
+
+    # one background notifier for each report source
+
+    # --------------------------------------------------------------------
+    def __init__(self):
+        self.interval = 1.0
+        self.retries = 3
+        self.notifiers = {}
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def get(self, report_source):
+        self.lock.acquire()
+        try:
+            if report_source not in self.notifiers:
+                n = RemoteNotifier(report_source, self.interval, self.retries)
+                n.start()
+                self.notifiers[report_source] = n
+            return self.notifiers[report_source]
+        finally:
+            self.lock.release()
+
+    # --------------------------------------------------------------------
+    def stop(self, timeout):
+        # send everything that's still waiting and stop all notifiers, but wait no longer than timeout
+        for n in self.notifiers.values():
+            n.stop()
+        deadline = time.time() + timeout
+        for n in self.notifiers.values():
+            n.join(max(deadline - time.time(), 0))
+            if n.isAlive():
+                l.error("Giving up on notifications to remote '%s' not sent within %i seconds" % (n.report_source, timeout))
+
+remote_notifiers = RemoteNotifiers()
+
+# --------------------------------------------------------------------
+def report_pattern(name, instance):
+    return re.sub("job:", "", name) + "-" + instance + "-" + "*.b1k"
+
+# --------------------------------------------------------------------
+def prefetch_reports(views):
+    # group pull jobs by report source, so reports for all jobs
+    # of a client are fetched at once
+    sources = {}
+    for v in views:
+        try:
+            if v.get(v.section, 'direction') != 'pull':
+                continue
+            report_source = v.get(v.section, 'report_source')
+        except Exception, e:
+            # job_generator() will complain later
+            continue
+        sources.setdefault(report_source, []).append(report_pattern(v.section, v.runtime['instance']))
+
+    for report_source, patterns in sources.items():
+        try:
+            remote_reports.prefetch(report_source, patterns)
+        except Exception, e:
+            l.warning("Could not fetch reports from '%s', falling back to fetching them for each job. Exception: %s" % (report_source, str(e)))
+
 # --------------------------------------------------------------------
 def pull_report(report_source):
     l.debug("Pulling remote report '%s'" % report_source)
@@ -57,15 +329,22 @@ def pull_report(report_source):
 
 # ------------------------------------------------------------------------
 def job_generator(cfg, name, instance):
+    # each job gets its own view of configuration to set run-time options in
+    cfg = ConfigView(cfg, name)
     jdirection = cfg.get(name, 'direction')
+
     if jdirection == 'passive':
         return JobPassive(cfg, name, instance)
     if jdirection == 'push':
         return Job(cfg, name, instance)
     elif jdirection == 'pull':
         report_source = cfg.get(name, "report_source")
-        real_name = re.sub("job:", "", name)
-        report, report_file = pull_report(report_source + "/" + real_name + "-" + instance + "-" + "*.b1k")
+        pattern = report_pattern(name, instance)
+        prefetched = remote_reports.find(report_source, pattern)
+        if prefetched is not None:
+            report, report_file = prefetched
+        else:
+            report, report_file = pull_report(report_source + "/" + pattern)
 
         my_dest_section = None
         for s in report.sections():
@@ -106,7 +385,7 @@ class Job:
     COPY_STATUS_FAILED = "FAILED"
 
     params_required = ['type', 'direction', 'dest', 'report', 'include']
-    params_allowed = ['exclude', 'pre', 'post', 'instances', 'data_age', 'master_host', 'master_instance']
+    params_allowed = ['exclude', 'pre', 'post', 'instances', 'data_age', 'master_host', 'master_instance', 'stream', 'fan_out', 'parallel_streams']
 
     # --------------------------------------------------------------------
     def __init__(self, cfg, name, instance):
@@ -117,7 +396,12 @@ class Job:
 
         self.real_name = re.sub("job:", "", self.name)
 
-        cfg.validate(self.name, self.params_required, self.params_allowed)
+        # jobs that stream pre- script output to destinations don't need 'include'
+        params_required = self.params_required
+        if cfg.has_option(self.name, "stream"):
+            params_required = [p for p in params_required if p != 'include']
+
+        cfg.validate(self.name, params_required, self.params_allowed)
 
         cfg.set(name, "name", self.real_name)
 
@@ -160,6 +444,16 @@ class Job:
         self.data_age = cfg.get_exec_def(self.name, "data_age", '0')
         self.pre = cfg.get_def(self.name, "pre", '')
         self.post = cfg.get_def(self.name, "post", '')
+        self.stream = cfg.get_def(self.name, "stream", '')
+        if self.stream and not self.pre:
+            raise SyntaxError("Job with 'stream' option needs a 'pre' script")
+        if self.stream.find('/') != -1:
+            raise SyntaxError("'stream' needs to be a file name, not a path")
+        self.backup_dir = cfg.get_def('global', "backup_dir", tempfile.gettempdir())
+        # pre script output staged for remote destinations of a 'stream' job
+        self.stream_dir = None
+        self.stream_file = None
+        self.fan_out = cfg.get_def(self.name, "fan_out", "no") == "yes"
 
         self.copy_retry_min_sleep = int(cfg.get_def('global', "copy_retry_min_sleep", '60'))
         self.status_dir = cfg.get('global', "status_dir")
@@ -194,6 +488,8 @@ class Job:
             drd.dtype = d.type
             drd.path = d.path
             drd.status = d.status
+            drd.profile = d.profile
+            drd.stats = d.stats
             jrd.destinations.append(drd)
 
         return jrd
@@ -204,8 +500,7 @@ class Job:
         dest = cfg.get(self.name, "dest")
         dest_list = re.findall("([a-zA-Z][-_&/a-zA-Z0-9]*)", dest)
 
-        for d in dest_list:
-
+        for group, d in enumerate(dest_list):
             # handle background destination
             bg = False
             if d.endswith('&'):
@@ -223,7 +518,9 @@ class Job:
 
             for i in d_l:
                 try:
-                    self.dest.append(dest_generator(self, cfg, i, bg))
+                    dest = dest_generator(self, cfg, i, bg)
+                    dest.group = group
+                    self.dest.append(dest)
                 except Exception, e:
                     l.error("Cannot add destionation '%s' to job '%s'. Exception: %s" % (i, self.real_name, str(e)))
 
@@ -318,6 +615,12 @@ class Job:
     def intro(self):
         pass
 
+    # --------------------------------------------------------------------
+    def ready(self):
+        # is job ready to be processed further? (checked after intro, and
+        # again every report_poll_wait seconds for as long as it returns False)
+        return True
+
     # --------------------------------------------------------------------
     def outro(self):
         pass
@@ -362,8 +665,12 @@ class JobPassive(Job):
 
     # --------------------------------------------------------------------
     def outro(self):
+        # pending report updates would write the file again
+        for r in self.report:
+            r.flush()
         l.debug("Removing report file '%s'" % self.report_file)
         os.remove(self.report_file)
+
         Job.outro(self)
 
 
@@ -371,7 +678,7 @@ class JobPassive(Job):
 class JobPull(Job):
 
     params_required = ['type', 'direction', 'dest', 'report', 'include', 'report_source', 'report_poll_wait', 'report_poll_retries']
-    params_allowed = ['exclude']
+    params_allowed = ['exclude', 'report_cache_time']
 
     # --------------------------------------------------------------------
     def __init__(self, cfg, name, instance, remote_report, remote_report_file, dest_section):
@@ -379,9 +686,14 @@ class JobPull(Job):
         self.report_source = cfg.get(name, "report_source")
         self.report_poll_wait = int(cfg.get(name, "report_poll_wait"))
         self.report_poll_retries = int(cfg.get(name, "report_poll_retries"))
+        self.report_cache_time = float(cfg.get_def(name, "report_cache_time", "5"))
         self.remote_report = remote_report
         self.remote_report_file = remote_report_file
+        # remote report has just been pulled, but we don't have a local copy of it yet
+        self.remote_report_time = time.time()
+        self.remote_report_key = None
         self.dest_section = dest_section
+        self.notified = set()
 
         Job.__init__(self, cfg, name, instance)
 
@@ -394,6 +706,42 @@ class JobPull(Job):
             r.update()
 
 
+    # --------------------------------------------------------------------
+    def __fetch_remote_report(self, force=False):
+        # remote report is fetched at most once per report_cache_time seconds (unless forced)
+        if not force and time.time() - self.remote_report_time < self.report_cache_time:
+            return
+
+        local_dir = remote_reports.get_dir(self.report_source)
+        local_file = local_dir + "/" + self.remote_report_file
+
+        # rsync doesn't transfer the report if it hasn't changed
+        rsync = Rsync("remote_report", self.report_source + "/" + self.remote_report_file, local_dir, "")
+        rsync.run()
+        self.remote_report_time = time.time()
+
+        # and we don't parse it
+        st = os.stat(local_file)
+        key = (st.st_size, st.st_mtime)
+        if key == self.remote_report_key:
+            return
+
+        report = ConfigParser.RawConfigParser()
+        f = open(local_file)
+        report.readfp(f)
+        f.close()
+
+        l.debug("Remote report '%s' has changed (seq: %s)" % (self.remote_report_file, self.__seq(report)))
+        self.remote_report = report
+        self.remote_report_key = key
+
+    # --------------------------------------------------------------------
+    def __seq(self, report):
+        try:
+            return report.get("jobstatus:" + self.real_name, "seq")
+        except:
+            return "none"
+
     # --------------------------------------------------------------------
     def get_report_data(self):
         jrd = Values()
@@ -401,7 +749,7 @@ class JobPull(Job):
         js = "jobstatus:" + self.real_name
 
         try:
-            self.remote_report, self.remote_report_file = pull_report(self.report_source + "/" + self.remote_report_file)
+            self.__fetch_remote_report()
         except Exception, e:
             l.warning("Could not fetch remote report. Monitoring data may be inaccurate. Exception: %s" % str(e))
 
@@ -426,29 +774,30 @@ class JobPull(Job):
         drd.dtype = self.remote_report.get(self.dest_section, "type")
         drd.path = self.remote_report.get(self.dest_section, "path")
         drd.status = self.remote_report.get(self.dest_section, "status")
+        # data is actually transferred by us (report may be written before destination is set up)
+        drd.profile = ""
+        drd.stats = {}
+        if self.dest:
+            drd.profile = self.dest[0].profile
+            drd.stats = self.dest[0].stats
 
         jrd.destinations.append(drd)
 
         return jrd
 
     # --------------------------------------------------------------------
-    def __notify_remote(self, status):
-        l.debug("Sending notification '%s' to remote '%s'" % (status, self.report_source))
-
-        tmpdir = tempfile.mkdtemp(prefix="b1000-remote-notify-")
-        status_file = tmpdir + "/" + self.remote_report_file + "." + platform.node() + "." + status
-
-        # prepare message file
-        open(status_file, "w").close()
-
-        # rsync messge file
-        try:
-            rsync = Rsync("remote_notify", status_file, self.report_source, "")
-            rsync.run()
-        except:
-            raise
-        finally:
-            shutil.rmtree(tmpdir, ignore_errors=True)
+    def __notify_remote(self, status, wait=False):
+        # each status is sent only once
+        if status in self.notified:
+            return
+        self.notified.add(status)
+
+        l.debug("Queueing notification '%s' to remote '%s'" % (status, self.report_source))
+        notifier = remote_notifiers.get(self.report_source)
+        marker = self.remote_report_file + "." + platform.node() + "." + status
+        notifier.submit(marker)
+        if wait:
+            notifier.wait(marker)
 
     # --------------------------------------------------------------------
     def set_state(self, step, status):
@@ -462,25 +811,33 @@ class JobPull(Job):
     def intro(self):
         Job.intro(self)
 
-        retries = self.report_poll_retries
-        l.info("Polling remote job every %i seconds waiting for it to enter '%s' state (%i retries total)" % (self.report_poll_wait, Job.JOB_STEP_COPYING, retries))
+        self.poll_retries = self.report_poll_retries
+        l.info("Polling remote job every %i seconds waiting for it to enter '%s' state (%i retries total)" % (self.report_poll_wait, Job.JOB_STEP_COPYING, self.poll_retries))
+
+    # --------------------------------------------------------------------
+    def ready(self):
+        # remote passive job in 'COPYING' state means data is ready to be pulled
+        try:
+            self.__fetch_remote_report(True)
+        except Exception, e:
+            l.warning("Could not fetch remote report. Exception: %s" % str(e))
+
+        if self.get_report_data().step == Job.JOB_STEP_COPYING:
+            return True
 
-        # waiting for remote passive job to enter 'COPYING' state (means data is ready to be pulled)
-        while (retries>0):
-            step = self.get_report_data().step
-            if step == Job.JOB_STEP_COPYING:
-                break
-            l.debug("Report poll sleeping %i seconds (%i retries left)" % (self.report_poll_wait, retries))
-            time.sleep(self.report_poll_wait)
-            retries -= 1
+        self.poll_retries -= 1
 
         # remote passive job didn't enter 'COPYING' state
-        if retries<=0:
+        if self.poll_retries <= 0:
             raise RuntimeError("Data from remote passive job not ready for copying after %i*%i seconds" % (self.report_poll_retries, self.report_poll_wait))
 
+        l.debug("Remote job '%s' not ready, polling again in %i seconds (%i retries left)" % (self.full_name, self.report_poll_wait, self.poll_retries))
+        return False
+
     # --------------------------------------------------------------------
     def outro(self):
-        self.__notify_remote("done")
+        # job fails if remote doesn't get to know it's done
+        self.__notify_remote("done", True)
         Job.outro(self)
 
 
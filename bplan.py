@@ -0,0 +1,101 @@
+# Copyright (c) 2012 Jakub Filipowicz <jakubf@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+import platform
+import logging as l
+
+from breport import mysql_pool
+
+# ------------------------------------------------------------------------
+class Plan:
+
+    # defaults, as in 'plan' table definition
+    DEFAULT_MAX_BACKUP_AGE = 86400
+    DEFAULT_MAX_COPY_TIME = 3600
+
+    # --------------------------------------------------------------------
+    def __init__(self, cfg, name):
+
+        self.name = name
+        self.sname = "report:" + self.name
+
+        rtype = cfg.get(self.sname, "type")
+        if rtype != "mysql":
+            raise SyntaxError("Backup plan can be read only from 'mysql' report, not '%s'" % rtype)
+
+        self.server = cfg.get(self.sname, "server")
+        self.db = cfg.get(self.sname, "db")
+        self.user = cfg.get(self.sname, "user")
+        self.password = cfg.get(self.sname, "password")
+
+        self.host = platform.node()
+        self.now = time.time()
+
+        # (job name, instance) -> (last successful backup start time, max_backup_age, max_copy_time)
+        self.jobs = {}
+
+        self.__load()
+
+    # --------------------------------------------------------------------
+    def __load(self):
+        l.debug("Reading backup plan from report '%s'" % self.name)
+
+        conn = mysql_pool.get(self.sname, self.server, self.user, self.password, self.db)
+        conn.transaction(self.__read)
+
+        l.debug("Backup plan: %i job(s) with successful backups found" % len(self.jobs))
+
+    # --------------------------------------------------------------------
+    def __read(self, c):
+        # last successful backup for each job/instance run on this host, together with its plan
+        c.execute("""
+        SELECT j.name, j.instance, UNIX_TIMESTAMP(MAX(j.start_time)), MIN(p.max_backup_age), MAX(p.max_copy_time)
+        FROM jobs j
+        LEFT JOIN plan p ON p.job_name = j.name AND p.ignored = 0
+            AND COALESCE(p.master_host, '') = COALESCE(j.master_host, '')
+            AND COALESCE(p.master_instance, '') = COALESCE(j.master_instance, '')
+        WHERE j.host = %s AND j.step = 'DONE' AND j.status = 'OK'
+        GROUP BY j.name, j.instance
+        """, (self.host,))
+
+        for (name, instance, last_start, max_backup_age, max_copy_time) in c.fetchall():
+            if max_backup_age is None:
+                max_backup_age = self.DEFAULT_MAX_BACKUP_AGE
+            if max_copy_time is None:
+                max_copy_time = self.DEFAULT_MAX_COPY_TIME
+            self.jobs[(name, instance)] = (int(last_start), int(max_backup_age), int(max_copy_time))
+
+    # --------------------------------------------------------------------
+    def slack(self, name, instance):
+        # seconds left until job misses its max_backup_age, if started now
+        # jobs that have never succeeded have no slack at all
+        try:
+            (last_start, max_backup_age, max_copy_time) = self.jobs[(name, instance)]
+        except KeyError:
+            return float("-inf")
+
+        return last_start + max_backup_age - max_copy_time - self.now
+
+    # --------------------------------------------------------------------
+    def copy_time(self, name, instance):
+        try:
+            return self.jobs[(name, instance)][2]
+        except KeyError:
+            return self.DEFAULT_MAX_COPY_TIME
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -15,6 +15,8 @@
 # Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import re
+import time
 import logging as l
 
 from threading import Thread
@@ -26,28 +28,42 @@ from bjob import Job, job_generator, NoReportException
 # ------------------------------------------------------------------------
 class PreDispatcher(Dispatcher):
 
+    # --------------------------------------------------------------------
+    def priority(self, j):
+        # jobs closest to missing their max_backup_age go first
+        if isinstance(j, Job):
+            return self.plan.slack(j.real_name, j.instance)
+        cfg, job_name, instance = j
+        return self.plan.slack(re.sub("job:", "", job_name), instance)
+
     # --------------------------------------------------------------------
     def process(self, j):
-        self.cfg, self.job_name, self.instance = j
+        if isinstance(j, Job):
+            # job that wasn't ready last time we've checked
+            job = j
+        else:
+            job = self.__create(j)
+            if job is None:
+                return
 
         try:
-            job = job_generator(self.cfg, self.job_name, self.instance)
-        except NoReportException, e:
-            l.warning("Could not create pull job '%s' instance '%s'. Exception: %s" % (self.job_name, self.instance, e))
-            return
+            ready = job.ready()
         except Exception, e:
-            l.error("Could not create job '%s' (instance '%s'). Exception: %s" % (self.job_name, self.instance, str(e)))
+            job.set_status(Job.JOB_STATUS_FAILED)
+            l.error("Job '%s' failed while waiting to be ready. Exception: %s" % (job.full_name, str(e)))
             return
 
-        l.debug("Running job.intro()")
-        try:
-            job.intro()
-        except Exception, e:
-            job.set_status(Job.JOB_STATUS_FAILED)
-            l.error("job.intro() failed. Exception: %s" % str(e))
+        # don't hold the worker, check again later
+        if not ready:
+            self.queue(job, time.time() + job.report_poll_wait)
             return
 
-        if job.pre:
+        if job.stream:
+            l.debug("Job '%s' streams pre script output to destinations, putting to copy queue" % job.full_name)
+            job.set_step(Job.JOB_STEP_PRE)
+            self.dp_next.queue(job)
+
+        elif job.pre:
             l.debug("Dispatching job '%s' for Pre" % job.full_name)
 
             job.set_step(Job.JOB_STEP_PRE)
@@ -66,6 +82,29 @@ class PreDispatcher(Dispatcher):
             l.debug("No pre for job '%s', putting to copy queue" % job.full_name)
             self.dp_next.queue(job)
 
+    # --------------------------------------------------------------------
+    def __create(self, j):
+        cfg, job_name, instance = j
+
+        try:
+            job = job_generator(cfg, job_name, instance)
+        except NoReportException, e:
+            l.warning("Could not create pull job '%s' instance '%s'. Exception: %s" % (job_name, instance, e))
+            return None
+        except Exception, e:
+            l.error("Could not create job '%s' (instance '%s'). Exception: %s" % (job_name, instance, str(e)))
+            return None
+
+        l.debug("Running job.intro()")
+        try:
+            job.intro()
+        except Exception, e:
+            job.set_status(Job.JOB_STATUS_FAILED)
+            l.error("job.intro() failed. Exception: %s" % str(e))
+            return None
+
+        return job
+
 
 
 # ------------------------------------------------------------------------
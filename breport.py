@@ -18,9 +18,245 @@
 import os
 import re
 import time
+import glob
+import json
+import fcntl
 import logging as l
-import MySQLdb
 import ConfigParser
+import StringIO
+
+from threading import Thread, Lock, Condition
+
+# unreachable database server must not hold report writer (and spooled updates) for long
+MYSQL_CONNECT_TIMEOUT = 10
+
+# ------------------------------------------------------------------------
+def mysql_connect(server, user, password, db):
+    # MySQLdb is imported only when needed, so hosts with 'file' reports only don't load it
+    import MySQLdb
+    return MySQLdb.connect(host=server, user=user, passwd=password, db=db, connect_timeout=MYSQL_CONNECT_TIMEOUT)
+
+# ------------------------------------------------------------------------
+class MysqlConnection:
+
+    # --------------------------------------------------------------------
+    def __init__(self, server, user, password, db):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.db = db
+        self.conn = None
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def __close(self):
+        try:
+            self.conn.close()
+        except:
+            pass
+        self.conn = None
+
+    # --------------------------------------------------------------------
+    def transaction(self, fn, *args):
+        # run fn(cursor, *args) in a transaction
+        # on failure connection is dropped and transaction is retried once on a fresh one
+        self.lock.acquire()
+        try:
+            for attempt in (1, 2):
+                try:
+                    if self.conn is None:
+                        l.debug("Connecting to MySQL database '%s' on '%s'" % (self.db, self.server))
+                        self.conn = mysql_connect(self.server, self.user, self.password, self.db)
+                    c = self.conn.cursor()
+                    try:
+                        result = fn(c, *args)
+                    finally:
+                        c.close()
+                    self.conn.commit()
+                    return result
+                except Exception, e:
+                    self.__close()
+                    if attempt == 2:
+                        raise
+                    l.debug("MySQL transaction on '%s' failed, reconnecting. Exception: %s" % (self.server, str(e)))
+        finally:
+            self.lock.release()
+
+# ------------------------------------------------------------------------
+class MysqlPool:
+
+    # one connection per report section, shared by all jobs (and threads)
+
+    # --------------------------------------------------------------------
+    def __init__(self):
+        self.conns = {}
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def get(self, name, server, user, password, db):
+        self.lock.acquire()
+        try:
+            key = (name, server, user, password, db)
+            if key not in self.conns:
+                self.conns[key] = MysqlConnection(server, user, password, db)
+            return self.conns[key]
+        finally:
+            self.lock.release()
+
+mysql_pool = MysqlPool()
+
+# ------------------------------------------------------------------------
+class ReportWriter(Thread):
+
+    # Writes reports in background. Each report queued for writing is
+    # written once per flush, with the latest state of its job, no matter
+    # how many times it has been updated in the meantime.
+
+    # --------------------------------------------------------------------
+    def __init__(self, name, interval):
+        Thread.__init__(self, name="Rep-" + name)
+        self.daemon = True
+        self.interval = interval
+        self.cv = Condition()
+        self.pending = {} # id(report) -> report
+        self.writing = {}
+        self.flushing = 0
+        self.fin = False
+
+    # --------------------------------------------------------------------
+    def submit(self, report):
+        self.cv.acquire()
+        try:
+            self.pending[id(report)] = report
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def backlog(self):
+        self.cv.acquire()
+        try:
+            return len(self.pending) + len(self.writing)
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def flush(self, report=None):
+        # wait until report (or all reports, if None) is written
+        self.cv.acquire()
+        try:
+            self.flushing += 1
+            self.cv.notify_all()
+            if report is None:
+                while self.pending or self.writing:
+                    self.cv.wait()
+            else:
+                while id(report) in self.pending or id(report) in self.writing:
+                    self.cv.wait()
+            self.flushing -= 1
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def stop(self):
+        self.cv.acquire()
+        try:
+            self.fin = True
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
+        self.join()
+
+    # --------------------------------------------------------------------
+    def run(self):
+        while True:
+            self.cv.acquire()
+            try:
+                while not self.pending and not self.fin:
+                    self.cv.wait()
+                if not self.pending:
+                    break
+
+                # let more updates come in, unless someone waits for them to be written
+                deadline = time.time() + self.interval
+                while not self.fin and not self.flushing:
+                    now = time.time()
+                    if now >= deadline:
+                        break
+                    self.cv.wait(deadline - now)
+
+                self.writing = self.pending
+                self.pending = {}
+            finally:
+                self.cv.release()
+
+            started = time.time()
+            reports = self.writing.values()
+            for r in reports:
+                try:
+                    r.write()
+                except Exception, e:
+                    l.warning("Could not write report '%s' for job '%s'. Exception: %s" % (r.name, r.job.full_name, str(e)))
+
+            # written (or spooled), so nobody needs to wait for it anymore
+            self.cv.acquire()
+            try:
+                self.writing = {}
+                self.cv.notify_all()
+            finally:
+                self.cv.release()
+
+            # reports that write to a spool send everything at once
+            forward = getattr(reports[0], "forward", None)
+            if forward is not None:
+                forward()
+            took = time.time() - started
+
+            written = len(reports)
+            waiting = self.backlog()
+
+            if took > 10 * self.interval:
+                l.warning("Report writer '%s' is slow: %i report(s) written in %.1f seconds, %i waiting" % (self.name, written, took, waiting))
+            elif waiting:
+                l.debug("Report writer '%s': %i report(s) written, %i waiting" % (self.name, written, waiting))
+
+# ------------------------------------------------------------------------
+class ReportWriters:
+
+    # one background writer for each configured report
+
+    # --------------------------------------------------------------------
+    def __init__(self):
+        self.interval = 1.0
+        self.writers = {}
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def get(self, name):
+        self.lock.acquire()
+        try:
+            if name not in self.writers:
+                w = ReportWriter(name, self.interval)
+                w.start()
+                self.writers[name] = w
+            return self.writers[name]
+        finally:
+            self.lock.release()
+
+    # --------------------------------------------------------------------
+    def backlog(self):
+        return sum([w.backlog() for w in self.writers.values()])
+
+    # --------------------------------------------------------------------
+    def stop(self):
+        # write everything that's still waiting and stop all writers
+        backlog = self.backlog()
+        if backlog:
+            l.info("Writing %i remaining report update(s)" % backlog)
+        for w in self.writers.values():
+            w.stop()
+
+report_writers = ReportWriters()
 
 # ------------------------------------------------------------------------
 class Values:
@@ -51,9 +287,33 @@ class ReportFile:
         else:
             raise SyntaxError("Job may have only one 'file' report destination")
 
+        # sequence number of the last written report and its contents (without sequence number)
+        self.seq = 0
+        self.last = None
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def __getstate__(self):
+        # report gets pickled together with failed jobs, lock can't be
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    # --------------------------------------------------------------------
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
 
     # --------------------------------------------------------------------
     def update(self):
+        report_writers.get(self.sname).submit(self)
+
+    # --------------------------------------------------------------------
+    def flush(self):
+        report_writers.get(self.sname).flush(self)
+
+    # --------------------------------------------------------------------
+    def write(self):
 
         rd = self.job.get_report_data()
 
@@ -85,11 +345,254 @@ class ReportFile:
             report.set(dname, 'type', d.dtype)
             report.set(dname, 'path', d.path)
             report.set(dname, 'status', d.status)
+            report.set(dname, 'profile', d.profile)
+            for s in COPY_STATS:
+                if s in d.stats:
+                    report.set(dname, s, d.stats[s])
+
+        contents = StringIO.StringIO()
+        report.write(contents)
+        contents = contents.getvalue()
+
+        self.lock.acquire()
+        try:
+            # nothing changed, nothing to write
+            if contents == self.last:
+                return
+
+            # sequence number lets readers cheaply tell if anything has changed
+            self.seq += 1
+            report.set(jname, 'seq', str(self.seq))
+
+            # readers never see partially written file
+            reportname = self.path + "/" + rd.name + "-" + rd.instance + "-" + safe_start_time + ".b1k"
+            tmpname = self.path + "/.tmp-" + rd.name + "-" + rd.instance + "-" + safe_start_time + ".b1k"
+            r = open(tmpname, 'wb')
+            try:
+                report.write(r)
+            finally:
+                r.close()
+            os.rename(tmpname, reportname)
+
+            self.last = contents
+        finally:
+            self.lock.release()
 
-        reportname = self.path + "/" + rd.name + "-" + rd.instance + "-" + safe_start_time + ".b1k"
-        r = open(reportname, 'wb')
-        report.write(r)
-        r.close()
+# ------------------------------------------------------------------------
+# transfer statistics reported for each copy (as collected by Rsync.run())
+COPY_STATS = ['files', 'files_transferred', 'literal_data', 'matched_data', 'bytes_sent', 'bytes_received', 'elapsed']
+
+# ------------------------------------------------------------------------
+# SQL dialects for writing reports (MySQL is the real thing, SQLite is for testing)
+MYSQL = {
+    'param': '%s',
+    'job_upsert': "ON DUPLICATE KEY UPDATE job_id = LAST_INSERT_ID(job_id), step = VALUES(step), status = VALUES(status)",
+    'copy_upsert': "ON DUPLICATE KEY UPDATE status = VALUES(status), profile = VALUES(profile), %s" % ", ".join(["%s = VALUES(%s)" % (s, s) for s in COPY_STATS]),
+    'last_insert_id': True,
+}
+
+SQLITE = {
+    'param': '?',
+    'job_upsert': "ON CONFLICT (start_time, host, name, instance) DO UPDATE SET step = excluded.step, status = excluded.status",
+    'copy_upsert': "ON CONFLICT (job_id, destination) DO UPDATE SET status = excluded.status, profile = excluded.profile, %s" % ", ".join(["%s = excluded.%s" % (s, s) for s in COPY_STATS]),
+    'last_insert_id': False,
+}
+
+# ------------------------------------------------------------------------
+def report_record(rd):
+    # report data as a plain dict, ready to be spooled
+    record = {
+        'host': rd.host,
+        'name': rd.name,
+        'instance': rd.instance,
+        'master_host': rd.master_host,
+        'master_instance': rd.master_instance,
+        'direction': rd.jdirection,
+        'start_time': time.strftime("%Y-%m-%d %H:%M:%S", rd.start_time),
+        'step': rd.step,
+        'status': rd.status,
+        'data_age': rd.data_age,
+        'destinations': [],
+    }
+    for d in rd.destinations:
+        record['destinations'].append({
+            'name': d.name,
+            'type': d.dtype,
+            'path': d.path,
+            'status': d.status,
+            'profile': d.profile,
+            'stats': d.stats,
+        })
+    return record
+
+# ------------------------------------------------------------------------
+def write_records(c, records, dialect=MYSQL):
+    # write report records using cursor c, it's safe to write the same record many times
+    p = dialect['param']
+
+    # only the latest state of each job matters
+    latest = {}
+    order = []
+    for r in records:
+        key = (r['start_time'], r['host'], r['name'], r['instance'])
+        if key not in latest:
+            order.append(key)
+        latest[key] = r
+
+    for key in order:
+        r = latest[key]
+
+        c.execute("""
+        INSERT INTO jobs (host, name, instance, master_host, master_instance, direction, start_time, step, status, data_age)
+        VALUES (%s)
+        %s
+        """ % (", ".join([p] * 10), dialect['job_upsert']), (r['host'], r['name'], r['instance'], r['master_host'], r['master_instance'], r['direction'], r['start_time'], r['step'], r['status'], r['data_age']))
+
+        job_id = None
+        if dialect['last_insert_id']:
+            job_id = c.lastrowid
+
+        # nothing inserted, nothing updated, let's find the job id
+        if not job_id:
+            c.execute("""
+            SELECT job_id from jobs where start_time = %s and host = %s and name = %s and instance = %s
+            """ % (p, p, p, p), key)
+            (job_id,) = c.fetchone()
+
+        if not r['destinations']:
+            continue
+
+        # write all destinations at once
+        values = []
+        for d in r['destinations']:
+            values += [job_id, d['name'], d['type'], d['path'], d['status'], d.get('profile', '')]
+            values += [d.get('stats', {}).get(s) for s in COPY_STATS]
+
+        columns = ['job_id', 'destination', 'type', 'path', 'status', 'profile'] + COPY_STATS
+
+        c.execute("""
+        INSERT INTO copies (%s)
+        VALUES %s
+        %s
+        """ % (", ".join(columns), ", ".join(["(%s)" % ", ".join([p] * len(columns))] * len(r['destinations'])), dialect['copy_upsert']), values)
+
+# ------------------------------------------------------------------------
+class ReportSpool:
+
+    # Append-only local spool of report records. Each process appends to
+    # its own (locked) file, spool files left by finished processes are
+    # forwarded by whoever comes next.
+
+    # --------------------------------------------------------------------
+    def __init__(self, directory, name):
+        self.prefix = "%s/report-%s-" % (directory, name)
+        self.path = "%s%i.spool" % (self.prefix, os.getpid())
+        self.name = name
+        self.f = None
+        self.failing = False
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def append(self, record):
+        self.lock.acquire()
+        try:
+            if self.f is None:
+                self.f = open(self.path, "a")
+                fcntl.flock(self.f, fcntl.LOCK_EX)
+            self.f.write(json.dumps(record) + "\n")
+            self.f.flush()
+        finally:
+            self.lock.release()
+
+    # --------------------------------------------------------------------
+    def __read(self, path):
+        records = []
+        f = open(path, "r")
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                l.warning("Skipping damaged record in report spool '%s'" % path)
+        f.close()
+        return records
+
+    # --------------------------------------------------------------------
+    def __forward_stale(self, send):
+        # spool files of other processes that are not running anymore
+        stale = [p for p in glob.glob(self.prefix + "*.spool") if p != self.path]
+        stale.sort(key=lambda p: os.path.getmtime(p))
+
+        for path in stale:
+            f = open(path, "r")
+            try:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                records = self.__read(path)
+                l.info("Forwarding %i record(s) left in report spool '%s'" % (len(records), path))
+                if records:
+                    send(records)
+                os.remove(path)
+            finally:
+                f.close()
+
+    # --------------------------------------------------------------------
+    def forward(self, send):
+        # send(records) must write all records, or raise
+        self.lock.acquire()
+        try:
+            try:
+                self.__forward_stale(send)
+                if self.f is not None:
+                    records = self.__read(self.path)
+                    if records:
+                        send(records)
+                        os.ftruncate(self.f.fileno(), 0)
+            except Exception, e:
+                if not self.failing:
+                    l.warning("Could not forward report '%s', updates are kept in spool '%s'. Exception: %s" % (self.name, self.path, str(e)))
+                self.failing = True
+                return False
+            if self.failing:
+                l.info("Report '%s' is available again, spooled updates forwarded" % self.name)
+            self.failing = False
+            return True
+        finally:
+            self.lock.release()
+
+# ------------------------------------------------------------------------
+class ReportSpools:
+
+    # --------------------------------------------------------------------
+    def __init__(self):
+        self.spools = {}
+        self.lock = Lock()
+
+    # --------------------------------------------------------------------
+    def get(self, directory, name):
+        self.lock.acquire()
+        try:
+            key = (directory, name)
+            if key not in self.spools:
+                self.spools[key] = ReportSpool(directory, name)
+            return self.spools[key]
+        finally:
+            self.lock.release()
+
+report_spools = ReportSpools()
+
+# ------------------------------------------------------------------------
+def forward_spools(cfg):
+    # forward whatever is left in spools of all mysql reports (also those not used in this run)
+    status_dir = cfg.get('global', 'status_dir')
+    for s in cfg.sections():
+        if not s.startswith("report:") or cfg.get_def(s, "type", "") != "mysql":
+            continue
+        name = re.sub("report:", "", s)
+        conn = mysql_pool.get(s, cfg.get(s, "server"), cfg.get(s, "user"), cfg.get(s, "password"), cfg.get(s, "db"))
+        spool = report_spools.get(status_dir, name)
+        spool.forward(lambda records: conn.transaction(write_records, records, MYSQL))
 
 # ------------------------------------------------------------------------
 class ReportMysql:
@@ -115,54 +618,33 @@ class ReportMysql:
         self.db = cfg.get(self.sname, "db")
         self.user = cfg.get(self.sname, "user")
         self.password = cfg.get(self.sname, "password")
-        self.__check_connection()
+        self.status_dir = cfg.get('global', "status_dir")
 
     # --------------------------------------------------------------------
-    def __check_connection(self):
-        db = MySQLdb.connect(host=self.server, user=self.user, passwd=self.password, db=self.db)
-        c = db.cursor()
-        rows = c.execute("SELECT count(*) from jobs")
-        result = c.fetchone()
-        c.close()
-        db.close()
+    def __connection(self):
+        return mysql_pool.get(self.sname, self.server, self.user, self.password, self.db)
 
     # --------------------------------------------------------------------
     def update(self):
+        report_writers.get(self.sname).submit(self)
 
-        rd = self.job.get_report_data()
-
-        start_time = time.strftime("%Y-%m-%d %H:%M:%S", rd.start_time)
-
-        db = MySQLdb.connect(host=self.server, user=self.user, passwd=self.password, db=self.db)
-        c = db.cursor()
-
-        # write job
-        rows = c.execute("""
-        INSERT INTO jobs (host, name, instance, master_host, master_instance, direction, start_time, step, status, data_age)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE step = %s, status = %s
-        """, (rd.host, rd.name, rd.instance, rd.master_host, rd.master_instance, rd.jdirection, start_time, rd.step, rd.status, rd.data_age, rd.step, rd.status))
+    # --------------------------------------------------------------------
+    def flush(self):
+        report_writers.get(self.sname).flush(self)
 
-        job_id = c.lastrowid
+    # --------------------------------------------------------------------
+    def write(self):
+        # only to local spool, forward() sends it to the database
+        rd = self.job.get_report_data()
+        report_spools.get(self.status_dir, self.name).append(report_record(rd))
 
-        # nothing inserted, nothing updated, let's find the job id
-        if rows == 0 and job_id == 0:
-            c.execute("""
-            SELECT job_id from jobs where start_time = %s and host = %s and name = %s and instance = %s
-            """, (start_time, rd.host, rd.name, rd.instance))
-            (job_id,) = c.fetchone()
+    # --------------------------------------------------------------------
+    def forward(self):
+        report_spools.get(self.status_dir, self.name).forward(self.__send)
 
-        # write all destinations
-        for d in rd.destinations:
-            rows = c.execute("""
-            INSERT INTO copies (job_id, destination, type, path, status)
-            VALUES (%s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE status = %s
-            """, (job_id, d.name, d.dtype, d.path, d.status, d.status))
-
-        c.close()
-        db.commit()
-        db.close()
+    # --------------------------------------------------------------------
+    def __send(self, records):
+        self.__connection().transaction(write_records, records, MYSQL)
 
 
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -16,37 +16,101 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import errno
 import logging as l
 import subprocess
 
+from collections import deque
+from threading import Thread, currentThread
+
+# --------------------------------------------------------------------
+class OutputPump:
+
+    # Process output handler: logs every 'sample'-th line (none if 0),
+    # keeps the last lines in a ring buffer and (optionally) writes all
+    # the output to a side file.
+
+    # --------------------------------------------------------------------
+    def __init__(self, name, lvl=l.DEBUG, keep=0, sample=1, side_file=None):
+        self.name = name
+        self.lvl = lvl
+        self.sample = sample
+        self.tail = deque(maxlen=max(keep, 20))
+        self.partial = ""
+        self.lines = 0
+        self.logged = 0
+        self.side = None
+        if side_file:
+            try:
+                self.side = open(side_file, "ab")
+            except Exception, e:
+                l.warning("[%s] Could not open output file '%s'. Exception: %s" % (name, side_file, str(e)))
+
+    # --------------------------------------------------------------------
+    def __line(self, line):
+        self.lines += 1
+        self.tail.append(line)
+        if self.sample and self.lines % self.sample == 0:
+            l.log(self.lvl, "[%s] %s" % (self.name, line))
+            self.logged += 1
+
+    # --------------------------------------------------------------------
+    def feed(self, data):
+        if self.side is not None:
+            self.side.write(data)
+
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.__line(line)
+
+    # --------------------------------------------------------------------
+    def close(self, failed=False):
+        if self.partial:
+            self.__line(self.partial)
+            self.partial = ""
+
+        if self.side is not None:
+            self.side.close()
+            self.side = None
+
+        if self.logged < self.lines:
+            l.log(self.lvl, "[%s] %i line(s) of output, %i logged" % (self.name, self.lines, self.logged))
+            # what went wrong may be among lines not logged
+            if failed:
+                for line in self.tail:
+                    l.warning("[%s] %s" % (self.name, line))
+
 # --------------------------------------------------------------------
-def run_and_log(cmd,name=None, lvl=l.DEBUG):
+def run_and_log(cmd,name=None, lvl=l.DEBUG, keep=0, sample=1, side_file=None):
+    # returns last 'keep' lines of output
 
     if name is None:
         name = cmd.split(" ")[0].split("/")[-1]
 
+    pump = OutputPump(name, lvl, keep, sample, side_file)
+
     # start process
     process = subprocess.Popen(cmd, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-    fd = process.stdout
+    fd = process.stdout.fileno()
 
-    # process and log output
-    while not fd.closed:
-        line = ""
-        try:
-            line = fd.readline()
-        except:
-            pass
-
-        if line:
-            l.log(lvl, "[%s] %s" % (name, line.rstrip("\n")))
-        else:
+    # process and log output, in big chunks
+    try:
+        while True:
             try:
-                fd.close()
-            except:
-                pass
-
-    process.wait()
-    ret = process.poll()
+                data = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            pump.feed(data)
+    finally:
+        process.stdout.close()
+        process.wait()
+        ret = process.poll()
+        pump.close(ret != 0)
 
     if ret < 0:
         raise OSError("Process terminated by signal: %i" % -ret)
@@ -55,6 +119,60 @@ def run_and_log(cmd,name=None, lvl=l.DEBUG):
     else:
         pass
 
+    if not keep:
+        return []
+    return list(pump.tail)[-keep:]
+
+# --------------------------------------------------------------------
+def run_to_files(cmd, filenames, name=None, lvl=l.DEBUG):
+
+    if name is None:
+        name = cmd.split(" ")[0].split("/")[-1]
+
+    outs = []
+    try:
+        for f in filenames:
+            outs.append(open(f, "wb"))
+
+        # start process, its error output gets logged while standard output is copied to all files
+        process = subprocess.Popen(cmd, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        t = Thread(target=log_lines, args=(process.stderr, name, lvl), name=currentThread().getName())
+        t.start()
+
+        fd = process.stdout.fileno()
+        try:
+            while True:
+                try:
+                    data = os.read(fd, 65536)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if not data:
+                    break
+                for o in outs:
+                    o.write(data)
+        finally:
+            process.stdout.close()
+            t.join()
+            process.wait()
+    finally:
+        for o in outs:
+            o.close()
+
+    ret = process.poll()
+
+    if ret < 0:
+        raise OSError("Process terminated by signal: %i" % -ret)
+    elif ret > 0:
+        raise OSError("Process exited with code: %i" % ret)
+
+# --------------------------------------------------------------------
+def log_lines(fd, name, lvl=l.DEBUG):
+    for line in iter(fd.readline, ""):
+        l.log(lvl, "[%s] %s" % (name, line.rstrip("\n")))
+    fd.close()
+
 # --------------------------------------------------------------------
 def get_lock(name):
     if os.access(name, os.F_OK):
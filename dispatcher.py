@@ -16,54 +16,128 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import time
+import heapq
 import logging as l
-import Queue
-from threading import Thread
+from threading import Thread, Condition
 
 # ------------------------------------------------------------------------
 class Dispatcher(Thread):
 
     # --------------------------------------------------------------------
-    def __init__(self, dp_name, dp_next):
-        l.debug("Initializing %s Dispatcher" % dp_name)
+    def __init__(self, dp_name, dp_next, workers=1, plan=None):
+        l.debug("Initializing %s Dispatcher (%i workers)" % (dp_name, workers))
         Thread.__init__(self, name=dp_name)
         self.name = dp_name
-        self.q = Queue.Queue()
+        self.timers = [] # heap of (when, seq, prio, item) for items that are not due yet
+        self.q = [] # heap of (prio, seq, item) for items ready to process
+        self.seq = 0
+        self.plan = plan
+        self.cv = Condition()
         self.dp_next = dp_next
         self.fin = False
+        if workers < 1:
+            raise ValueError("%s Dispatcher needs at least one worker" % dp_name)
+        self.workers = workers
+        self.busy = 0
 
     # --------------------------------------------------------------------
     def finish(self):
-        self.fin = True
+        self.cv.acquire()
+        try:
+            self.fin = True
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def priority(self, o):
+        # lower value goes first, items of equal priority are processed in FIFO order
+        return 0
 
     # --------------------------------------------------------------------
     def queue(self, o, when=None):
-        self.q.put((o, when))
+        prio = 0
+        if self.plan is not None:
+            prio = self.priority(o)
+
+        self.cv.acquire()
+        try:
+            if when is None:
+                heapq.heappush(self.q, (prio, self.seq, o))
+            else:
+                heapq.heappush(self.timers, (when, self.seq, prio, o))
+            self.seq += 1
+            self.cv.notify()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def get(self):
+        # returns next due item or None if dispatcher is finished, queue is empty
+        # and no worker is busy (busy workers may still put items back to queue)
+        self.cv.acquire()
+        try:
+            while True:
+                # move items that are due to the ready queue
+                now = time.time()
+                while self.timers and self.timers[0][0] <= now:
+                    (when, seq, prio, o) = heapq.heappop(self.timers)
+                    heapq.heappush(self.q, (prio, seq, o))
+
+                if self.q:
+                    self.busy += 1
+                    return heapq.heappop(self.q)[2]
+                elif self.timers:
+                    # sleep until the nearest item is due (or something new gets queued)
+                    self.cv.wait(self.timers[0][0] - now)
+                elif self.fin and self.busy == 0:
+                    return None
+                else:
+                    self.cv.wait()
+        finally:
+            self.cv.release()
+
+    # --------------------------------------------------------------------
+    def done(self):
+        self.cv.acquire()
+        try:
+            self.busy -= 1
+            self.cv.notify_all()
+        finally:
+            self.cv.release()
 
     # --------------------------------------------------------------------
     def process(self, i):
         raise NotImplementedError("Dispatcher.process() method not implemented")
 
     # --------------------------------------------------------------------
-    def run(self):
-        l.debug("Running %s Dispatcher" % self.name)
-
-        while not (self.fin and self.q.empty()):
-            try:
-                (i, when) = self.q.get(True, 0.3)
-                now = time.time()
-                # is it time for this?
-                if (when is not None) and (when > now):
-                    self.queue(i, when)
-                    time.sleep(0.5)
-                    continue
-            except Queue.Empty:
-                continue
+    def work(self):
+        while True:
+            i = self.get()
+            if i is None:
+                break
 
             try:
                 self.process(i)
             except Exception, e:
                 l.error("Exception while processing %s: %s" % (str(i), str(e)))
+            finally:
+                self.done()
+
+    # --------------------------------------------------------------------
+    def run(self):
+        l.debug("Running %s Dispatcher" % self.name)
+
+        if self.workers == 1:
+            self.work()
+        else:
+            workers = []
+            for n in range(self.workers):
+                w = Thread(target=self.work, name="%s-%i" % (self.name, n))
+                w.start()
+                workers.append(w)
+            for w in workers:
+                w.join()
 
         if self.dp_next is not None:
             self.dp_next.finish()
@@ -42,6 +42,14 @@ CREATE TABLE copies (
   type varchar(31) NOT NULL,
   path varchar(1024) NOT NULL,
   status enum('INIT', 'COPYING', 'DONE', 'WARNING', 'FAILED') NOT NULL DEFAULT 'INIT',
+  profile varchar(31) NOT NULL DEFAULT '',
+  files bigint DEFAULT NULL,
+  files_transferred bigint DEFAULT NULL,
+  literal_data bigint DEFAULT NULL,
+  matched_data bigint DEFAULT NULL,
+  bytes_sent bigint DEFAULT NULL,
+  bytes_received bigint DEFAULT NULL,
+  elapsed int(11) DEFAULT NULL,
   last_op_time timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (copy_id),
   UNIQUE KEY (job_id, destination)
@@ -18,15 +18,35 @@
 import os
 import os.path
 import re
+import errno
+import time
 import subprocess
 import logging as l
 import tempfile
 
+from threading import Lock
 from butils import run_and_log
 
+# transfer profiles: options added and removed for each kind of link to destination
+PROFILES = {
+    # local disk: nothing to gain from compression nor from delta transfer
+    'local': (['W'], ['z']),
+    # fast network: compressing costs more than it saves
+    'lan': ([], ['z']),
+    # slow network: compress, but not what's compressed already
+    'wan': (['z', 'skip-compress=gz/tgz/bz2/tbz/xz/txz/lz4/lzo/zst/zip/7z/rar/jpg/jpeg/png/gif/mp3/mp4/avi/mkv'], []),
+}
+
 # ------------------------------------------------------------------------
 class Rsync:
 
+    # remote servers understand --mkpath (rsync >= 3.2.3), no need to create directories separately
+    mkpath = False
+
+    # remote directories created so far, for each destination root
+    created = {}
+    created_lock = Lock()
+
     # --------------------------------------------------------------------
     def __init__(self, name, src, dst, exclude, timeout=20):
         self.rsync_cmd = "rsync"
@@ -35,6 +55,7 @@ class Rsync:
 
         self.src = src
         self.dst = dst
+        self.include = ""
         self.exclude = ""
         self.timeout = "--timeout=%i --contimeout=%i" % (timeout, timeout)
         if exclude:
@@ -47,6 +68,9 @@ class Rsync:
 
         self.verbosity = 0
         self.opts = self.defopts
+        self.stats = {}
+        self.output_sample = 1
+        self.output_file = None
 
         # doesn't work in 2.5
         #self.__check_version()
@@ -62,6 +86,13 @@ class Rsync:
             raise LookupError("Can't parse rsync version string")
         self.ver_rsync, self.ver_proto = r.groups()
 
+    # --------------------------------------------------------------------
+    def set_include(self, include):
+        # include rules go before excludes, first matching rule wins
+        self.include = ""
+        for i in include:
+            self.include += " --include '%s' " % i
+
     # --------------------------------------------------------------------
     def get_version(self):
         return self.ver_rsync, self.ver_proto
@@ -85,6 +116,43 @@ class Rsync:
     def get_opts(self):
         return self.opts
 
+    # --------------------------------------------------------------------
+    def set_profile(self, profile, compress_level=None):
+        add, remove = PROFILES[profile]
+        self.remove_opts(remove)
+        self.add_opts(add)
+        if compress_level is not None and 'z' in self.opts:
+            self.add_opts(["compress-level=%i" % compress_level])
+
+    # --------------------------------------------------------------------
+    def __parse_stats(self, lines):
+        # numbers printed with --stats (older rsync versions don't count regular files separately)
+        stats_re = [
+            ('files', "^Number of files: ([0-9,]+)"),
+            ('files_transferred', "^Number of (?:regular )?files transferred: ([0-9,]+)"),
+            ('literal_data', "^Literal data: ([0-9,]+) bytes"),
+            ('matched_data', "^Matched data: ([0-9,]+) bytes"),
+            ('bytes_sent', "^Total bytes sent: ([0-9,]+)"),
+            ('bytes_received', "^Total bytes received: ([0-9,]+)"),
+        ]
+
+        for line in lines:
+            for key, regex in stats_re:
+                r = re.search(regex, line)
+                if r:
+                    self.stats[key] = int(r.group(1).replace(",", ""))
+
+            # "sent 1,234 bytes  received 56 bytes  2,580.00 bytes/sec"
+            r = re.search("sent ([0-9,.]+) bytes +received ([0-9,.]+) bytes +([0-9,.]+) bytes/sec", line)
+            if r:
+                self.stats['rate'] = float(r.group(3).replace(",", ""))
+
+    # --------------------------------------------------------------------
+    def set_output(self, sample, output_file=None):
+        # log every sample-th line of output (none if 0), all of it goes to output_file
+        self.output_sample = sample
+        self.output_file = output_file
+
     # --------------------------------------------------------------------
     def set_verbosity(self, v):
         if v < 0:
@@ -107,19 +175,47 @@ class Rsync:
 
         return po
                 
+    # --------------------------------------------------------------------
+    def __created(self, root, subdir):
+        Rsync.created_lock.acquire()
+        try:
+            return subdir in Rsync.created.get(root, ())
+        finally:
+            Rsync.created_lock.release()
+
+    # --------------------------------------------------------------------
+    def __add_created(self, root, subdir):
+        Rsync.created_lock.acquire()
+        try:
+            dirs = Rsync.created.setdefault(root, set())
+            # all parents got created too
+            while subdir:
+                dirs.add(subdir)
+                subdir = os.path.dirname(subdir)
+        finally:
+            Rsync.created_lock.release()
+
     # --------------------------------------------------------------------
     def mkdir(self, dest):
 
         # this is another not-so-nasty hack to "make dirs" on server side
         if dest.startswith("rsync://"):
+            if Rsync.mkpath:
+                l.debug("Remote subdirectories of '%s' will be created by rsync itself" % dest)
+                return
+
             try:
                 chunks = re.search("(rsync://[^/]+/[^/]+)/(.*)", dest)
                 root = chunks.group(1)
-                subdir = chunks.group(2)
+                subdir = chunks.group(2).strip("/")
             except Exception, e:
                 l.debug("No subdirectories to create on remote '%s'" % (dest))
                 return
 
+            if not subdir or self.__created(root, subdir):
+                l.debug("Subdirectories '%s' on '%s' already created" % (subdir, root))
+                return
+
             tmpdir = tempfile.mkdtemp(prefix="b1000-rsync-mkdir-")
             the_dir = "%s/%s" % (tmpdir, subdir)
             os.makedirs(the_dir)
@@ -130,12 +226,18 @@ class Rsync:
 
             run_and_log(cmd)
             os.removedirs(the_dir)
+            self.__add_created(root, subdir)
 
         # locally, just mkdirs()
         elif dest.startswith("/"):
             if not os.path.isdir(dest):
                 l.debug("Creating local subdirectories: '%s'" % dest)
-                os.makedirs(dest)
+                try:
+                    os.makedirs(dest)
+                except OSError, e:
+                    # created by someone else in the meantime (eg. another rsync stream)
+                    if e.errno != errno.EEXIST:
+                        raise
             else:
                 l.debug("Local directory '%s' exists, no need to create one" % dest)
 
@@ -154,9 +256,15 @@ class Rsync:
 
         # start rsync process
         try:
-            cmd = "%s %s %s %s %s %s" % (self.rsync_cmd, self.exclude, self.timeout, self.__prep_opts(), self.src, self.dst)
+            opts = self.__prep_opts()
+            if Rsync.mkpath and self.dst.startswith("rsync://"):
+                opts += " --mkpath"
+            cmd = "%s %s %s %s %s %s %s" % (self.rsync_cmd, self.include, self.exclude, self.timeout, opts, self.src, self.dst)
             l.debug("Running rsync command: %s" % cmd)
-            run_and_log(cmd, "rsync " + self.name)
+            started = time.time()
+            self.stats = {}
+            self.__parse_stats(run_and_log(cmd, "rsync " + self.name, keep=30, sample=self.output_sample, side_file=self.output_file))
+            self.stats['elapsed'] = int(round(time.time() - started))
         except Exception, e:
             raise OSError("Exception while running rsync: %s" % str(e))
 
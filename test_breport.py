@@ -0,0 +1,94 @@
+# Copyright (c) 2012 Jakub Filipowicz <jakubf@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+import sqlite3
+
+from breport import write_records, SQLITE, COPY_STATS
+
+# ------------------------------------------------------------------------
+class WriteRecordsTest(unittest.TestCase):
+
+    # Replaying spooled report records (see: ReportSpool) against SQLite
+
+    # --------------------------------------------------------------------
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        c = self.db.cursor()
+        c.execute("""
+        CREATE TABLE jobs (
+          job_id integer PRIMARY KEY AUTOINCREMENT,
+          host, name, instance, master_host, master_instance, direction, start_time, step, status, data_age,
+          UNIQUE (start_time, host, name, instance)
+        )""")
+        c.execute("""
+        CREATE TABLE copies (
+          job_id, destination, type, path, status, profile, %s,
+          UNIQUE (job_id, destination)
+        )""" % ", ".join(COPY_STATS))
+
+    # --------------------------------------------------------------------
+    def record(self, name, step, status, copy_status):
+        return {
+            'host': 'h', 'name': name, 'instance': '', 'master_host': '', 'master_instance': '',
+            'direction': 'push', 'start_time': '2012-01-01 00:00:00', 'step': step, 'status': status, 'data_age': '0',
+            'destinations': [{'name': 'd', 'type': 'active', 'path': '/srv/' + name, 'status': copy_status, 'profile': 'local', 'stats': {'files': 1}}],
+        }
+
+    # --------------------------------------------------------------------
+    def forward(self, records):
+        c = self.db.cursor()
+        write_records(c, records, SQLITE)
+        self.db.commit()
+
+    # --------------------------------------------------------------------
+    def rows(self):
+        c = self.db.cursor()
+        c.execute("SELECT j.name, j.step, j.status, c.status, c.files FROM jobs j JOIN copies c ON c.job_id = j.job_id ORDER BY j.name")
+        return c.fetchall()
+
+    # --------------------------------------------------------------------
+    def test_replay(self):
+        first = [
+            self.record('a', 'PRE', 'OK', 'INIT'),
+            self.record('b', 'COPYING', 'OK', 'COPYING'),
+            self.record('a', 'COPYING', 'OK', 'COPYING'),
+            self.record('a', 'COPYING', 'OK', 'COPYING'),
+        ]
+        second = [
+            self.record('b', 'DONE', 'OK', 'DONE'),
+            self.record('a', 'DONE', 'WARNING', 'WARNING'),
+        ]
+
+        self.forward(first)
+        self.assertEqual(self.rows(), [('a', 'COPYING', 'OK', 'COPYING', 1), ('b', 'COPYING', 'OK', 'COPYING', 1)])
+
+        # spool that couldn't be truncated after sending gets sent again, with what came later
+        self.forward(first + second)
+        self.forward(second)
+        self.assertEqual(self.rows(), [('a', 'DONE', 'WARNING', 'WARNING', 1), ('b', 'DONE', 'OK', 'DONE', 1)])
+
+        c = self.db.cursor()
+        c.execute("SELECT count(*) FROM jobs")
+        self.assertEqual(c.fetchone()[0], 2)
+        c.execute("SELECT count(*) FROM copies")
+        self.assertEqual(c.fetchone()[0], 2)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4